@@ -0,0 +1,4 @@
+"""Benchmarks of photosort on synthetic media trees.
+
+Run "python -m bench --help" from the top of the source tree.
+"""
@@ -0,0 +1,132 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import time
+import json
+import random
+import hashlib
+
+import photosort as ps
+from photosort import digestset
+
+
+def _digests(rng, n):
+    return [hashlib.md5(rng.getrandbits(64).to_bytes(8, "little"))\
+        .hexdigest() for x in range(n)]
+
+
+def check_digestset(rng, scale):
+    """Add many digests to a loaded DigestSet, as a bulk import does, and
+    check that the pending set stays bounded and lookups stay right.
+    """
+    base = sorted(_digests(rng, 100000 * scale))
+    added = _digests(rng, 300000 * scale)
+    missing = _digests(rng, 10000)
+    ds = ps.DigestSet(base)
+    start = time.perf_counter()
+    largest = 0
+    for hx in added:
+        ds.add(hx)
+        largest = max(largest, len(ds._pending))
+    seconds = time.perf_counter() - start
+    if largest >= digestset.merge_pending:
+        raise RuntimeError("pending digests grew to {}".format(largest))
+    if len(ds) != len(base) + len(added):
+        raise RuntimeError("DigestSet has {} digests, not {}".format(
+            len(ds), len(base) + len(added)))
+    for hx in base[::97] + added[::97]:
+        if hx not in ds:
+            raise RuntimeError("digest {} lost".format(hx))
+    for hx in missing:
+        if hx in ds:
+            raise RuntimeError("digest {} wrongly found".format(hx))
+    return {
+        "digests": len(ds),
+        "largest_pending": largest,
+        "bytes_per_digest": ds.nbytes / len(ds),
+        "add_us": 1.0e6 * seconds / len(added),
+    }
+
+
+def _near(rng, key, maxdist):
+    for bit in rng.sample(range(64), rng.randint(0, maxdist)):
+        key ^= 1 << bit
+    return key
+
+
+def check_similar(rng, scale, nquery=200):
+    """Time near-duplicate searches in indexes of n and 4n random hashes.
+
+    A linear search would be 4 times slower in the larger index.  Results
+    of some searches are compared with a brute force scan, which must be
+    at least 10 times slower.
+    """
+    ret = dict()
+    small = 50000 * scale
+    keys = [rng.getrandbits(64) for x in range(4 * small)]
+    per_query = dict()
+    for n in [small, 4 * small]:
+        index = ps.HammingIndex()
+        start = time.perf_counter()
+        for indx in range(n):
+            index.add(keys[indx], indx)
+        build = time.perf_counter() - start
+        queries = [_near(rng, keys[rng.randrange(n)], ps.near_distance) \
+            for x in range(nquery)]
+        start = time.perf_counter()
+        for q in queries:
+            index.search(q, ps.near_distance)
+        per_query[n] = (time.perf_counter() - start) / nquery
+        nscan = 5
+        start = time.perf_counter()
+        for q in queries[0:nscan]:
+            expected = sorted([(ps.hamming(q, keys[x]), x) for x in \
+                range(n) if ps.hamming(q, keys[x]) <= ps.near_distance])
+            if index.search(q, ps.near_distance) != expected:
+                raise RuntimeError("wrong search result in {} hashes"\
+                    .format(n))
+        scan = (time.perf_counter() - start) / nscan
+        ret["build_s_{}".format(n)] = build
+        ret["query_ms_{}".format(n)] = 1.0e3 * per_query[n]
+        ret["scan_ms_{}".format(n)] = 1.0e3 * scan
+    ret["query_growth_4x"] = per_query[4 * small] / \
+        max(per_query[small], 1.0e-9)
+    if scan < 10.0 * per_query[4 * small]:
+        raise RuntimeError("searching {} hashes takes {:.2f}ms, close to "
+            "the {:.2f}ms of a scan".format(4 * small,
+            1.0e3 * per_query[4 * small], 1.0e3 * scan))
+    return ret
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(\
+        description="Check that the in-memory indexes of photosort stay "
+        "bounded and fast as they grow, and write the numbers as JSON." )
+    parser.add_argument( "--scale", required=False, type=int, default=1,
+        help="multiply the number of items by this" )
+    parser.add_argument( "--seed", required=False, type=int, default=12345,
+        help="random seed" )
+    args = parser.parse_args()
+
+    results = dict()
+    for name, func in checks:
+        rng = random.Random(args.seed)
+        results[name] = func(rng, max(1, args.scale))
+        print("{:12s} {}".format(name, ", ".join(["{}={}".format(k,
+            round(v, 3) if isinstance(v, float) else v) for k, v in \
+            sorted(results[name].items())])), file=sys.stderr)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return
+
+
+checks = [
+    ("digestset", check_digestset),
+    ("similar", check_similar),
+]
+
+
+if __name__ == "__main__":
+    main()
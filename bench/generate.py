@@ -0,0 +1,195 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import io
+import math
+import random
+import struct
+import datetime
+
+try:
+    from PIL import Image as PILImage
+    have_pillow = True
+except ImportError:
+    have_pillow = False
+
+
+# Stand-in file types, with the default share of files and median size in
+# bytes of each.
+default_mix = {
+    "jpg": (0.70, 3000000),
+    "nef": (0.20, 20000000),
+    "mov": (0.10, 40000000),
+}
+
+cameras = [
+    ("Canon", "Canon EOS 5D Mark III"),
+    ("NIKON CORPORATION", "NIKON D750"),
+    ("SONY", "ILCE-7M3"),
+    ("Apple", "iPhone 8"),
+]
+
+# Seconds between 1904-01-01 (QuickTime epoch) and 1970-01-01.
+_qt_epoch = 2082844800
+
+
+def tiff_block(date, make, model):
+    """Return a little endian TIFF structure with camera and date tags.
+
+    IFD0 holds Make, Model and a pointer to an EXIF IFD with
+    DateTimeOriginal.  This is the payload of a JPEG APP1 segment, and the
+    start of a TIFF based RAW file.
+    """
+    datestr = date.strftime("%Y:%m:%d %H:%M:%S").encode("ascii") + b"\0"
+    make = make.encode("ascii") + b"\0"
+    model = model.encode("ascii") + b"\0"
+    # Layout:  header (8), IFD0 (2 + 3 * 12 + 4), EXIF IFD (2 + 12 + 4),
+    # then the string values.
+    ifd0_off = 8
+    exif_off = ifd0_off + 2 + 3 * 12 + 4
+    data_off = exif_off + 2 + 12 + 4
+    make_off = data_off
+    model_off = make_off + len(make)
+    date_off = model_off + len(model)
+    out = io.BytesIO()
+    out.write(b"II*\0" + struct.pack("<I", ifd0_off))
+    out.write(struct.pack("<H", 3))
+    out.write(struct.pack("<HHII", 0x010f, 2, len(make), make_off))
+    out.write(struct.pack("<HHII", 0x0110, 2, len(model), model_off))
+    out.write(struct.pack("<HHII", 0x8769, 4, 1, exif_off))
+    out.write(struct.pack("<I", 0))
+    out.write(struct.pack("<H", 1))
+    out.write(struct.pack("<HHII", 0x9003, 2, len(datestr), date_off))
+    out.write(struct.pack("<I", 0))
+    out.write(make + model + datestr)
+    return out.getvalue()
+
+
+def _filler(rng, size):
+    # Incompressible bytes, so that sizes and throughputs are realistic.
+    if size <= 0:
+        return b""
+    return rng.getrandbits(8 * size).to_bytes(size, "little")
+
+
+def make_jpeg(rng, size, date, make, model, decodable=False):
+    exif = b"Exif\0\0" + tiff_block(date, make, model)
+    if decodable and have_pillow:
+        # A real image whose file size is roughly the requested size.
+        side = max(16, int(math.sqrt(size / 1.5)))
+        width = side * 4 // 3
+        height = side
+        img = PILImage.frombytes("RGB", (width, height),
+            _filler(rng, width * height * 3))
+        buf = io.BytesIO()
+        img.save(buf, "JPEG", quality=90, exif=exif)
+        return buf.getvalue()
+    app1 = b"\xff\xe1" + struct.pack(">H", len(exif) + 2) + exif
+    head = b"\xff\xd8" + app1
+    return head + _filler(rng, size - len(head) - 2) + b"\xff\xd9"
+
+
+def make_raw(rng, size, date, make, model):
+    head = tiff_block(date, make, model)
+    return head + _filler(rng, size - len(head))
+
+
+def make_mov(rng, size, date, make, model):
+    ftyp = struct.pack(">I", 20) + b"ftypqt  " + struct.pack(">I", 0) + \
+        b"qt  "
+    secs = int((date - datetime.datetime(1970, 1, 1)).total_seconds()) + \
+        _qt_epoch
+    # Version 0 mvhd:  creation and modification times, time scale and
+    # duration, then 80 bytes we leave zero.
+    body = struct.pack(">IIIII", 0, secs, secs, 600, 600 * 10) + b"\0" * 80
+    mvhd = struct.pack(">I", len(body) + 8) + b"mvhd" + body
+    moov = struct.pack(">I", len(mvhd) + 8) + b"moov" + mvhd
+    nfill = max(0, size - len(ftyp) - len(moov) - 8)
+    mdat = struct.pack(">I", nfill + 8) + b"mdat" + _filler(rng, nfill)
+    return ftyp + moov + mdat
+
+
+_makers = {
+    "jpg": make_jpeg,
+    "nef": make_raw,
+    "mov": make_mov,
+}
+
+
+def generate_tree(root, nfiles, seed=12345, mix=None, scale=1.0,
+    sigma=0.5, start=(2010, 1, 1), end=(2020, 1, 1), dup_frac=0.05,
+    other_frac=0.02, perdir=50, decodable=False):
+    """Write a synthetic tree of media stand-ins.
+
+    nfiles files are written below root, perdir per directory.  The type
+    of each file is drawn from mix, a dictionary of extension to (share,
+    median size), and its size from a log-normal distribution with that
+    median times scale and the given sigma.  Dates are uniform between
+    start and end, and embedded where exiftool looks for them.  A fraction
+    dup_frac of the files are copies of earlier ones, and other_frac are
+    non-media files.  With decodable (and Pillow), JPEGs are real images.
+    The same arguments always produce the same tree.  Returns a dictionary
+    with the number of files and bytes written.
+    """
+    if mix is None:
+        mix = default_mix
+    rng = random.Random(seed)
+    exts = sorted(mix.keys())
+    weights = [mix[x][0] for x in exts]
+    tstart = datetime.datetime(*start)
+    span = (datetime.datetime(*end) - tstart).total_seconds()
+    written = list()
+    nbytes = 0
+    for indx in range(nfiles):
+        subdir = os.path.join(root, "dir{:04d}".format(indx // perdir))
+        os.makedirs(subdir, exist_ok=True)
+        draw = rng.random()
+        if (draw < dup_frac) and (len(written) > 0):
+            src = written[rng.randrange(len(written))]
+            with open(src, "rb") as f:
+                data = f.read()
+            ext = os.path.splitext(src)[1].lstrip(".")
+            path = os.path.join(subdir, "dup{:06d}.{}".format(indx, ext))
+        elif draw < dup_frac + other_frac:
+            data = _filler(rng, rng.randrange(100, 10000))
+            path = os.path.join(subdir, "notes{:06d}.txt".format(indx))
+        else:
+            ext = rng.choices(exts, weights=weights)[0]
+            median = mix[ext][1] * scale
+            size = max(512, int(rng.lognormvariate(math.log(median), sigma)))
+            date = tstart + datetime.timedelta(seconds=int(rng.random() * \
+                span))
+            make, model = cameras[rng.randrange(len(cameras))]
+            if ext == "jpg":
+                data = make_jpeg(rng, size, date, make, model,
+                    decodable=decodable)
+            else:
+                data = _makers[ext](rng, size, date, make, model)
+            path = os.path.join(subdir, "img{:06d}.{}".format(indx, ext))
+            written.append(path)
+        with open(path, "wb") as f:
+            f.write(data)
+        nbytes += len(data)
+    return {"files": nfiles, "bytes": nbytes}
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(\
+        description="Write a synthetic media tree for benchmarks." )
+    parser.add_argument( "--out", required=True, help="output directory" )
+    parser.add_argument( "--files", required=False, type=int, default=200,
+        help="number of files" )
+    parser.add_argument( "--scale", required=False, type=float,
+        default=0.01, help="multiply the median file sizes by this" )
+    parser.add_argument( "--seed", required=False, type=int, default=12345,
+        help="random seed" )
+    parser.add_argument( "--decodable", required=False, default=False,
+        action="store_true", help="write real JPEG images (needs Pillow)" )
+    args = parser.parse_args()
+    ret = generate_tree(args.out, args.files, seed=args.seed,
+        scale=args.scale, decodable=args.decodable)
+    print("wrote {} files ({:.2f}MB) to {}".format(ret["files"],
+        ret["bytes"] / 1.0e6, args.out))
@@ -0,0 +1,332 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import time
+import json
+import shutil
+import platform
+import resource
+import tempfile
+import multiprocessing
+
+import photosort as ps
+from photosort import exiftool as _exiftool
+
+from .generate import generate_tree, have_pillow
+
+
+stub_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub")
+
+
+def _media(top):
+    return [x for x in ps.scan_tree(top, kinds=("image", "video"))]
+
+
+def _total(recs):
+    return sum([x.stat.st_size for x in recs])
+
+
+def run_file_md5(ctx):
+    recs = _media(ctx["tree"])
+    for rec in recs:
+        ps.file_md5(rec.path)
+    return len(recs), _total(recs)
+
+
+def run_import_media(ctx):
+    lib = ctx["library"]
+    # Files without a usable date go to "broken", as with phts_sync.
+    os.makedirs(os.path.join(lib, "broken"), exist_ok=True)
+    db = ps.DB(os.path.join(lib, ps.library_name),
+        commit_interval=ctx["commit_interval"])
+    nfiles = 0
+    nbytes = 0
+    for root, entries in ps.scan_dirs(ctx["tree"], kinds=("image", "video")):
+        ps.import_media(db, root, [x.name for x in entries], lib, None)
+        nfiles += len(entries)
+        nbytes += _total(entries)
+    db.close()
+    return nfiles, nbytes
+
+
+def run_import_tree(ctx):
+    lib = ctx["library_jobs"]
+    # Files without a usable date go to "broken", as with phts_sync.
+    os.makedirs(os.path.join(lib, "broken"), exist_ok=True)
+    db = ps.DB(os.path.join(lib, ps.library_name),
+        commit_interval=ctx["commit_interval"])
+    ps.import_tree(db, ctx["tree"], lib, None, jobs=ctx["jobs"])
+    db.close()
+    recs = _media(ctx["tree"])
+    return len(recs), _total(recs)
+
+
+def run_index_media(ctx):
+    # Index the library written by import_media into a separate DB.
+    path = os.path.join(ctx["work"], "index.db")
+    for suffix in ["", "-wal", "-shm"]:
+        if os.path.isfile(path + suffix):
+            os.remove(path + suffix)
+    db = ps.DB(path, commit_interval=ctx["commit_interval"],
+        root=ctx["library"])
+    nfiles = 0
+    nbytes = 0
+    for root, entries in ps.scan_dirs(ctx["library"], kinds=("image",
+        "video")):
+        ps.index_media(db, root, [x.name for x in entries])
+        nfiles += len(entries)
+        nbytes += _total(entries)
+    db.close()
+    return nfiles, nbytes
+
+
+def run_check_media(ctx):
+    db = ps.DB(os.path.join(ctx["library"], ps.library_name))
+    nfiles = 0
+    nbytes = 0
+    for root, entries in ps.scan_dirs(ctx["tree"], kinds=("image", "video")):
+        ps.check_media(db, root, [x.name for x in entries], ctx["library"],
+            0)
+        nfiles += len(entries)
+        nbytes += _total(entries)
+    db.close()
+    return nfiles, nbytes
+
+
+def _run_export(ctx, res):
+    outdir = os.path.join(ctx["work"], "export_{}".format(res))
+    if os.path.isdir(outdir):
+        shutil.rmtree(outdir)
+    os.makedirs(outdir)
+    recs = [x for x in _media(ctx["library"]) if x.kind == "image"]
+    if res != "FULL":
+        # Only JPEGs can be scaled without external tools.
+        recs = [x for x in recs if ps.resize_supported(x.path, "pillow")]
+    metas = ps.file_json_batch([x.path for x in recs])
+    for rec, meta in zip(recs, metas):
+        obj = ps.Image(rec.path, meta=meta, st=rec.stat)
+        obj.export(outdir, resolution=res, link=ctx["link"],
+            backend="pillow")
+    return len(recs), _total(recs)
+
+
+def run_export_full(ctx):
+    return _run_export(ctx, "FULL")
+
+
+def run_export_med(ctx):
+    return _run_export(ctx, "MED")
+
+
+# Scenarios in the order they run.  Later ones use the output of earlier
+# ones:  import_media writes the library that the others read.
+scenarios = [
+    ("file_md5", run_file_md5),
+    ("import_media", run_import_media),
+    ("import_tree", run_import_tree),
+    ("index_media", run_index_media),
+    ("check_media", run_check_media),
+    ("export_full", run_export_full),
+    ("export_med", run_export_med),
+]
+
+_depends = {
+    "index_media": "import_media",
+    "check_media": "import_media",
+    "export_full": "import_media",
+    "export_med": "import_media",
+}
+
+
+def _child(conn, func, ctx):
+    # Run one scenario and send back its counters.  Output of the library
+    # goes to /dev/null unless asked for.
+    if not ctx["verbose"]:
+        null = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(null, 1)
+        os.close(null)
+    ret = dict()
+    if ctx["profile"]:
+        ps.instrument.enable()
+    try:
+        start = time.perf_counter()
+        nfiles, nbytes = func(ctx)
+        ret["seconds"] = time.perf_counter() - start
+        ret["files"] = nfiles
+        ret["bytes"] = nbytes
+    except Exception as e:
+        ret["error"] = "{}: {}".format(type(e).__name__, e)
+    if ctx["profile"]:
+        ret["profile"] = ps.instrument.report()["stages"]
+    # Stop exiftool, so that its usage is included with the children.
+    _exiftool._close_pools()
+    sys.stdout.flush()
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    unit = 1024.0
+    if sys.platform == "darwin":
+        unit = 1.0
+    ret["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF)\
+        .ru_maxrss * unit / 1.0e6
+    ret["children_peak_rss_mb"] = resource.getrusage(\
+        resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1.0e6
+    conn.send(ret)
+    conn.close()
+
+
+def run_scenario(name, func, ctx):
+    """Run one scenario in a forked process and return its results.
+
+    A fresh process per scenario gives each one its own peak RSS, and
+    keeps state such as exiftool pools from leaking between them.
+    """
+    mp = multiprocessing.get_context("fork")
+    parent, child = mp.Pipe(duplex=False)
+    proc = mp.Process(target=_child, args=(child, func, ctx))
+    proc.start()
+    child.close()
+    try:
+        ret = parent.recv()
+    except EOFError:
+        ret = {"error": "benchmark process died"}
+    proc.join()
+    if "seconds" in ret:
+        elapsed = max(ret["seconds"], 1.0e-9)
+        ret["files_per_s"] = ret["files"] / elapsed
+        ret["mb_per_s"] = ret["bytes"] / 1.0e6 / elapsed
+    return ret
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(\
+        description="Time photosort operations on a synthetic media tree "
+        "and write the results as JSON." )
+    parser.add_argument( "--work", required=False, default=None,
+        help="working directory (default:  a temporary directory that is "
+        "removed afterwards)" )
+    parser.add_argument( "--files", required=False, type=int, default=200,
+        help="number of files in the synthetic tree" )
+    parser.add_argument( "--scale", required=False, type=float,
+        default=0.01, help="multiply the median file sizes (3MB JPEG, 20MB "
+        "RAW, 40MB video) by this" )
+    parser.add_argument( "--seed", required=False, type=int, default=12345,
+        help="random seed of the synthetic tree" )
+    parser.add_argument( "--decodable", required=False, default=False,
+        action="store_true", help="write real JPEG images (needs Pillow), "
+        "which is required for the export_med scenario" )
+    parser.add_argument( "--scenario", required=False, default=[],
+        action="append", choices=[x[0] for x in scenarios],
+        help="only run this scenario (may be given several times)" )
+    parser.add_argument( "--jobs", required=False, type=int, default=4,
+        help="worker threads of the import_tree scenario" )
+    parser.add_argument( "--commitinterval", required=False, type=int,
+        default=500, help="number of DB inserts per transaction" )
+    parser.add_argument( "--link", required=False, default="copy",
+        choices=ps.link_modes, help="how export_full places files" )
+    parser.add_argument( "--stub", required=False, default="auto",
+        choices=["auto", "always", "never"], help="use the stub exiftool "
+        "in bench/stub.  The default (auto) uses it if exiftool is not "
+        "installed" )
+    parser.add_argument( "--output", required=False, default=None,
+        help="write the JSON results to this file instead of stdout" )
+    parser.add_argument( "--profile", required=False, default=False,
+        action="store_true", help="include the time spent in each stage "
+        "of photosort in the results" )
+    parser.add_argument( "--verbose", required=False, default=False,
+        action="store_true", help="show the output of photosort" )
+    args = parser.parse_args()
+
+    if (args.stub == "always") or ((args.stub == "auto") and \
+        (shutil.which("exiftool") is None)):
+        os.environ["PATH"] = stub_dir + os.pathsep + os.environ["PATH"]
+    exiftool = shutil.which("exiftool")
+
+    tmp = None
+    work = args.work
+    if work is None:
+        tmp = tempfile.mkdtemp(prefix="photosort_bench_")
+        work = tmp
+    work = os.path.abspath(work)
+    ctx = {
+        "work": work,
+        "tree": os.path.join(work, "tree"),
+        "library": os.path.join(work, "library"),
+        "library_jobs": os.path.join(work, "library_jobs"),
+        "jobs": args.jobs,
+        "commit_interval": args.commitinterval,
+        "link": args.link,
+        "verbose": args.verbose,
+        "profile": args.profile,
+    }
+
+    selected = args.scenario
+    if len(selected) == 0:
+        selected = [x[0] for x in scenarios]
+    needed = set(selected)
+    for name in selected:
+        if name in _depends:
+            needed.add(_depends[name])
+
+    try:
+        for path in [ctx["tree"], ctx["library"], ctx["library_jobs"]]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+        start = time.perf_counter()
+        tree = generate_tree(ctx["tree"], args.files, seed=args.seed,
+            scale=args.scale, decodable=args.decodable)
+        tree["seconds"] = time.perf_counter() - start
+
+        results = dict()
+        for name, func in scenarios:
+            if name not in needed:
+                continue
+            if (name == "export_med") and not (args.decodable and \
+                have_pillow):
+                results[name] = {"skipped": "needs --decodable and Pillow"}
+                continue
+            ret = run_scenario(name, func, ctx)
+            if name in selected:
+                results[name] = ret
+            print("{:12s} {}".format(name, ", ".join(["{}={}".format(k,
+                round(v, 3) if isinstance(v, float) else v) for k, v in \
+                sorted(ret.items()) if k != "profile"])), file=sys.stderr)
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        "photosort": ps.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "exiftool": exiftool,
+        "stub_exiftool": (exiftool is not None) and \
+            exiftool.startswith(stub_dir),
+        "pillow": have_pillow,
+        "params": {
+            "files": args.files,
+            "scale": args.scale,
+            "seed": args.seed,
+            "decodable": args.decodable,
+            "jobs": args.jobs,
+            "commit_interval": args.commitinterval,
+            "link": args.link,
+            "profile": args.profile,
+        },
+        "tree": tree,
+        "scenarios": results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    return
+
+
+if __name__ == "__main__":
+    main()
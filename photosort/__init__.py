@@ -10,12 +10,54 @@ from __future__ import (absolute_import, division, print_function,
 
 from ._version import __version__
 
-from .media import (Image, Video, image_raw_ext, image_nonraw_ext, image_ext,
+from .media import (Media, Image, Video, image_raw_ext, image_nonraw_ext, image_ext,
     video_ext, file_md5, file_setdate, file_json, is_image, is_video,
     file_date, good_date, file_rootname, file_ckname, is_subdir,
-    file_setmetadate, file_format)
+    file_setmetadate, file_format, file_json_batch, file_fingerprint,
+    file_setmetadate_batch, image_ext_set, video_ext_set, media_kinds,
+    file_ext, media_kind, video_duration, meta_summary)
 
-from .db import DB
+from .scan import ScanEntry, ExcludeRules, scan_tree, scan_dirs
 
-from .ops import (album_append, index_media, import_media, check_media,
-    convert_video, upgrade_video)
+from .hashing import (hash_algorithms, new_hash, file_digest,
+    file_drop_cache)
+
+from .transfer import (copy_file, set_file_date, date_timestamp, link_modes,
+    link_file, place_file)
+
+from .similar import (near_distance, dhash_size, hamming, dhash,
+    image_dhash, HammingIndex)
+
+from .digestset import DigestSet
+
+from .shard import (shard_modes, parse_shard, shard_db_name,
+    parse_shard_db_name, shard_of, ShardRules)
+
+from .resize import (have_pillow, resize_backends, resolution_scale,
+    resize_supported, resize_jpeg, pillow_enabled, preview_tags,
+    jpeg_dimensions, raw_dimensions, embedded_preview)
+
+from .exiftool import ExifTool, ExifToolPool, ExifToolError, exiftool_pool
+
+from .db import (DB, schema_version, media_columns, metadata_columns,
+    date_columns, journal_states)
+
+from .ops import (read_file_list, album_name, album_links,
+    materialize_album, album_append, index_media, reconcile_media,
+    import_destination, plan_imports, import_object, repair_journal,
+    import_media, check_media, convert_video, upgrade_video)
+
+from .manifest import (manifest_name, library_name, Manifest, TreeDigests,
+    export_manifest_name, ExportManifest)
+
+from .export import export_object, export_files, ExportStats
+
+from .pipeline import ImportStats, import_tree
+
+from .convert import (ledger_name, ConvertLedger, ConvertStats,
+    video_jobs, convert_videos)
+
+from . import instrument
+
+from .instrument import (StageStats, add_profile_option, profile_start,
+    profile_finish)
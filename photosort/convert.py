@@ -0,0 +1,200 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import time
+import sqlite3
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .media import file_json, file_rootname, file_format, video_duration
+
+from .exiftool import exiftool_pool
+
+from .scan import scan_tree
+
+from .ops import convert_video
+
+
+ledger_name = ".photosort_convert.db"
+
+
+class ConvertLedger(object):
+    """The outcome of video conversions into an output tree.
+
+    The ledger is a small sqlite file at the top of the output tree with
+    one entry per input file, keyed by its path and stat.  An entry is
+    only trusted while the input is unchanged.
+    """
+
+    def __init__(self, root, path=None):
+        self.root = root
+        if path is None:
+            path = os.path.join(root, ledger_name)
+        self.path = path
+        self.conn = sqlite3.connect(self.path)
+        cur = self.conn.cursor()
+        cur.execute('create table if not exists jobs (infile text primary '
+            'key, size integer, mtime integer, outfile text, status text, '
+            'seconds real, error text)')
+        self.conn.commit()
+
+    def lookup(self, infile, st):
+        """Return the (outfile, status) of an unchanged input, or None.
+        """
+        cur = self.conn.cursor()
+        cur.execute('select size, mtime, outfile, status from jobs where '
+            'infile = ?', (infile,))
+        row = cur.fetchone()
+        if (row is None) or (row[0:2] != (st.st_size, st.st_mtime_ns)):
+            return None
+        return (row[2], row[3])
+
+    def record(self, infile, st, outfile, status, seconds=None, error=None):
+        cur = self.conn.cursor()
+        cur.execute('insert or replace into jobs values (?, ?, ?, ?, ?, ?, '
+            '?)', (infile, st.st_size, st.st_mtime_ns, outfile, status,
+            seconds, error))
+        # Commit every job, since each one is expensive to redo.
+        self.conn.commit()
+        return
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.commit()
+            self.conn.close()
+            self.conn = None
+
+
+def video_jobs(indir, outdir, formats=["avi"], exclude=None):
+    """Return the (input, output) files to convert below indir.
+
+    The outputs mirror the directory structure of the inputs.
+    """
+    ret = list()
+    for rec in scan_tree(indir, exclude=exclude, kinds=("video",)):
+        inroot, chk = file_rootname(rec.name)
+        inbase, format = file_format(inroot)
+        if format not in formats:
+            continue
+        reldir = os.path.dirname(rec.relpath)
+        outfile = os.path.abspath(os.path.join(outdir, reldir,
+            "{}.{}".format(inbase, "m4v")))
+        ret.append((rec.path, outfile))
+    return ret
+
+
+class ConvertStats(object):
+    """Counters for a batch of video conversions.
+    """
+
+    def __init__(self, total):
+        self.start = time.time()
+        self.total = total
+        self.done = 0
+        self.converted = 0
+        self.current = 0
+        self.skipped = 0
+        self.failed = list()
+        self.bytes_in = 0
+        self.media_seconds = 0.0
+
+    def summary(self):
+        elapsed = max(time.time() - self.start, 1.0e-6)
+        lines = list()
+        lines.append("Converted {} of {} videos in {:.1f}s ({:.2f}MB/s, "
+            "{:.2f}x realtime)".format(self.converted, self.total, elapsed,
+            self.bytes_in / 1.0e6 / elapsed, self.media_seconds / elapsed))
+        if self.current > 0:
+            lines.append("  {} videos already converted".format(
+                self.current))
+        if self.skipped > 0:
+            lines.append("  {} videos skipped".format(self.skipped))
+        if len(self.failed) > 0:
+            lines.append("  {} conversions FAILED:".format(len(self.failed)))
+            for path, err in self.failed:
+                lines.append("    {}: {}".format(path, err))
+        return "\n".join(lines)
+
+
+def _convert(infile, outfile, force, skip_apple, threads, quiet):
+    start = time.time()
+    meta = file_json(infile)
+    os.makedirs(os.path.dirname(outfile), exist_ok=True)
+    converted = convert_video(infile, outfile, force=force,
+        skip_apple=skip_apple, threads=threads, quiet=quiet, meta=meta)
+    return converted, time.time() - start, video_duration(meta)
+
+
+def convert_videos(jobs, njobs=1, threads=None, ledger=None, force=False,
+    skip_apple=True):
+    """Run video conversions concurrently.
+
+    jobs is a list of (input, output) files.  At most njobs ffmpeg
+    processes run at once, and the threads budget (default:  the number of
+    CPUs) is split evenly between them.  With a ConvertLedger, finished
+    conversions of unchanged inputs are skipped, and any other existing
+    output (for example a partial file from an older version) is encoded
+    again.  Without one, existing outputs are skipped unless force is
+    True.  Returns the ConvertStats.
+    """
+    njobs = max(1, int(njobs))
+    if threads is None:
+        threads = os.cpu_count() or 1
+    per_job = max(1, int(threads) // njobs)
+    quiet = (njobs > 1)
+    exiftool_pool(njobs)
+    exiftool_pool(njobs, writer=True)
+    stats = ConvertStats(len(jobs))
+
+    with ThreadPoolExecutor(max_workers=njobs) as pool:
+        futures = dict()
+        for infile, outfile in jobs:
+            st = os.stat(infile)
+            redo = force
+            if ledger is not None:
+                prev = ledger.lookup(infile, st)
+                if (not force) and (prev is not None) and \
+                    (prev[0] == outfile) and (((prev[1] == "done") and \
+                    os.path.isfile(outfile)) or (prev[1] == "skipped")):
+                    stats.done += 1
+                    stats.current += 1
+                    continue
+                # Outputs not recorded as done are never trusted.
+                redo = True
+            fut = pool.submit(_convert, infile, outfile, redo, skip_apple,
+                per_job, quiet)
+            futures[fut] = (infile, outfile, st)
+        for fut in as_completed(futures):
+            infile, outfile, st = futures[fut]
+            stats.done += 1
+            prefix = "[{}/{}]".format(stats.done, stats.total)
+            try:
+                converted, seconds, duration = fut.result()
+            except Exception as e:
+                stats.failed.append((infile, str(e)))
+                if ledger is not None:
+                    ledger.record(infile, st, outfile, "failed",
+                        error=str(e))
+                print("{} FAILED {}: {}".format(prefix, infile, e),
+                    flush=True)
+                continue
+            if not converted:
+                stats.skipped += 1
+                if ledger is not None:
+                    ledger.record(infile, st, outfile, "skipped")
+                continue
+            stats.converted += 1
+            stats.bytes_in += st.st_size
+            speed = ""
+            if duration is not None:
+                stats.media_seconds += duration
+                speed = ", {:.2f}x realtime".format(duration /
+                    max(seconds, 1.0e-6))
+            if ledger is not None:
+                ledger.record(infile, st, outfile, "done", seconds=seconds)
+            print("{} Converted {} to {} in {:.1f}s ({:.2f}MB/s{})".format(
+                prefix, infile, outfile, seconds, st.st_size / 1.0e6 /
+                max(seconds, 1.0e-6), speed), flush=True)
+    return stats
@@ -7,14 +7,108 @@ import sys
 
 import sqlite3
 import re
+import json
+import zlib
+
+from .hashing import hash_algorithms
+
+from .instrument import stage
+
+from .media import Image, Video, media_kind, meta_summary
+
+from .similar import HammingIndex, near_distance, to_signed, from_signed
+
+from .digestset import DigestSet
+
+
+# Schema upgrades.  Entry N is the list of statements that upgrades a DB
+# from "pragma user_version" N to N + 1.  Version 0 is the original media
+# table, so existing DBs are upgraded in place when opened for writing.
+_migrations = [
+    # 1:  location and stat signature of each file in the tree
+    [
+        'alter table media add column path text',
+        'alter table media add column size integer',
+        'alter table media add column mtime integer',
+        'alter table media add column inode integer',
+        'create index if not exists media_path on media (path)',
+    ],
+    # 2:  partial checksum for quickly ruling out matches
+    [
+        'alter table media add column fprint text',
+        'create index if not exists media_size on media (size, fprint)',
+    ],
+    # 3:  digest algorithm of each row, and library-wide settings
+    [
+        'alter table media add column hashalg text',
+        "update media set hashalg = 'md5' where hashalg is null",
+        'create table if not exists settings (key text primary key, '
+        'value text)',
+    ],
+    # 4:  cached exiftool metadata, with a few values in their own columns
+    [
+        'create table if not exists metadata (md5 text primary key, '
+        'make text, model text, width integer, height integer, '
+        'duration real, datekey text, meta blob)',
+    ],
+    # 5:  indexes for date range and camera queries
+    [
+        'create index if not exists media_date on media (year, month, day, '
+        'hour)',
+        'create index if not exists metadata_camera on metadata (make, '
+        'model)',
+    ],
+    # 6:  perceptual hash of images, for finding near-duplicates
+    [
+        'alter table metadata add column dhash integer',
+    ],
+    # 7:  import journal, keyed by input path and stat
+    [
+        'create table if not exists journal (input text primary key, '
+        'size integer, mtime integer, inode integer, md5 text, output text, '
+        'state text)',
+    ],
+    # 8:  album membership, by media uid
+    [
+        'create table if not exists albums (album text, uid text, '
+        'primary key (album, uid))',
+    ],
+    # 9:  whether an import used file times, for repairing it the same way
+    [
+        'alter table journal add column file_time integer',
+    ],
+]
+
+# States of an input file in the import journal:  its copy is about to be
+# made, the copy is complete, or the file is in the media table.
+journal_states = ['planned', 'copied', 'committed']
+
+# Columns of a date, in the order of the media_date index.
+date_columns = ['year', 'month', 'day', 'hour', 'minute', 'second']
+
+schema_version = len(_migrations)
+
+media_columns = ['uid', 'name', 'md5', 'year', 'month', 'day', 'hour',
+    'minute', 'second', 'path', 'size', 'mtime', 'inode', 'fprint',
+    'hashalg']
+
+metadata_columns = ['md5', 'make', 'model', 'width', 'height', 'duration',
+    'datekey', 'dhash', 'meta']
 
 
 class DB(object):
 
 
-    def __init__(self, path, mode='w'):
+    def __init__(self, path, mode='w', commit_interval=1, wal=True,
+        root=None):
 
         self.path = path
+
+        # Paths in the DB are relative to this directory, which is the
+        # top of the media tree.
+        if root is None:
+            root = os.path.dirname(os.path.abspath(self.path))
+        self.root = root
         create = True
         if ( os.path.exists(self.path) ):
             create = False
@@ -24,6 +118,20 @@ class DB(object):
             raise RuntimeError(\
                 "cannot open a non-existent DB in read-only mode")
 
+        # Inserts are committed every commit_interval rows, and by
+        # commit() / close().
+        self.commit_interval = max(1, int(commit_interval))
+        self._pending = 0
+        self._sizes = None
+
+        # Imported images within this Hamming distance of an image in the
+        # DB are reported as near-duplicates.  None disables the check.
+        self.similar_distance = near_distance
+        self._similar = None
+
+        # All checksums, once preload_digests is called.
+        self._digests = None
+
         self.conn = None
         try:
             # only python3 supports uri option
@@ -35,8 +143,25 @@ class DB(object):
         except:
             self.conn = sqlite3.connect(self.path)
 
+        if (mode != 'r') and wal:
+            # With a write-ahead log, a commit is an append to the log
+            # instead of a rewrite of the pages plus a journal.
+            self.conn.execute('pragma journal_mode=WAL')
+            self.conn.execute('pragma synchronous=NORMAL')
+
         if create:
             self._init_schema()
+        if mode != 'r':
+            self._migrate()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+        return False
 
 
     def _init_schema(self):
@@ -46,15 +171,556 @@ class DB(object):
         return
 
 
-    def insert(self, obj):
+    def _migrate(self):
+        cur = self.conn.cursor()
+        cur.execute('pragma user_version')
+        version = cur.fetchone()[0]
+        while version < schema_version:
+            for stmt in _migrations[version]:
+                cur.execute(stmt)
+            version += 1
+            cur.execute('pragma user_version = {:d}'.format(version))
+            self.conn.commit()
+        return
+
+
+    def get_setting(self, key, default=None):
+        cur = self.conn.cursor()
+        try:
+            cur.execute('select value from settings where key = ?', (key,))
+        except sqlite3.OperationalError:
+            # An old DB opened read-only.
+            return default
+        row = cur.fetchone()
+        if row is None:
+            return default
+        return row[0]
+
+
+    def set_setting(self, key, value):
         cur = self.conn.cursor()
-        cur.execute('insert into media values (\"{}\", \"{}\", \"{}\", {}, {}, {}, {}, {}, {})'.format(obj.uid, obj.name, obj.md5, int(obj.year), int(obj.month), int(obj.day), int(obj.hour), int(obj.minute), int(obj.second)))
+        cur.execute('insert or replace into settings values (?, ?)',
+            (key, value))
         self.conn.commit()
+        return
+
+
+    @property
+    def hashalg(self):
+        """The digest algorithm used for files in this library.
+        """
+        return self.get_setting('hashalg', 'md5')
+
+
+    def set_hashalg(self, algorithm):
+        """Choose the digest algorithm.  Only possible while the DB is empty.
+        """
+        if algorithm == self.hashalg:
+            return
+        if algorithm not in hash_algorithms:
+            raise RuntimeError("unsupported hash algorithm {}"\
+                .format(algorithm))
+        cur = self.conn.cursor()
+        cur.execute('select count(*) from media')
+        if cur.fetchone()[0] > 0:
+            raise RuntimeError("DB {} already uses {} checksums.  Rebuild "
+                "the index to change the algorithm".format(self.path,
+                self.hashalg))
+        self.set_setting('hashalg', algorithm)
+        return
+
+
+    def relpath(self, path):
+        """Path of a file relative to the root of the media tree.
+        """
+        return os.path.relpath(os.path.abspath(path), self.root)
+
+
+    def _row(self, obj, path=None):
+        if path is None:
+            path = obj.path
+            st = obj.stat
+        else:
+            st = os.stat(path)
+        return (obj.uid, obj.name, obj.md5, int(obj.year), int(obj.month),
+            int(obj.day), int(obj.hour), int(obj.minute), int(obj.second),
+            self.relpath(path), st.st_size, st.st_mtime_ns, st.st_ino,
+            obj.fprint, obj.hashalg)
+
+
+    def _inserted(self, n):
+        self._sizes = None
+        self._pending += n
+        if self._pending >= self.commit_interval:
+            self.commit()
+        return
+
+
+    def _insert_sql(self):
+        return 'insert into media ({}) values ({})'.format(
+            ", ".join(media_columns), ", ".join(["?"] * len(media_columns)))
+
+
+    def _meta_row(self, obj):
+        blob = zlib.compress(json.dumps(obj.meta, sort_keys=True)\
+            .encode("utf-8"))
+        return (obj.md5,) + tuple(meta_summary(obj.meta)) + \
+            (obj.datekey, to_signed(obj.dhash), sqlite3.Binary(blob))
+
+
+    def _meta_sql(self):
+        return 'insert or replace into metadata ({}) values ({})'.format(
+            ", ".join(metadata_columns), ", ".join(["?"] * \
+            len(metadata_columns)))
+
+
+    def insert(self, obj, path=None):
+        """Insert a media object and cache its metadata.
+
+        The location recorded in the DB is obj.path, unless the file in the
+        media tree is at a different path.
+        """
+        with stage("db_insert"):
+            cur = self.conn.cursor()
+            cur.execute(self._insert_sql(), self._row(obj, path=path))
+            cur.execute(self._meta_sql(), self._meta_row(obj))
+        if self._digests is not None:
+            self._digests.add(obj.md5)
+        self._index_similar([obj])
+        self._inserted(1)
+
+
+    def insert_many(self, objs):
+        with stage("db_insert", items=len(objs)):
+            rows = [self._row(x) for x in objs]
+            cur = self.conn.cursor()
+            cur.executemany(self._insert_sql(), rows)
+            cur.executemany(self._meta_sql(), [self._meta_row(x) for x in \
+                objs])
+        if self._digests is not None:
+            for obj in objs:
+                self._digests.add(obj.md5)
+        self._index_similar(objs)
+        self._inserted(len(rows))
+
+
+    def store_meta(self, objs):
+        """Cache the metadata of objects which are already in the DB.
+        """
+        cur = self.conn.cursor()
+        cur.executemany(self._meta_sql(), [self._meta_row(x) for x in objs])
+        self._index_similar(objs)
+        self._inserted(len(objs))
+
+
+    def prune_meta(self):
+        """Remove cached metadata of checksums which are no longer indexed.
+        """
+        cur = self.conn.cursor()
+        cur.execute('delete from metadata where md5 not in (select md5 from '
+            'media)')
+        if cur.rowcount > 0:
+            self._similar = None
+        self._inserted(cur.rowcount)
+
+
+    def _index_similar(self, objs):
+        # Keep a loaded similarity index current.
+        if self._similar is None:
+            return
+        for obj in objs:
+            if obj.dhash is not None:
+                self._similar.add(obj.dhash, obj.md5)
+
+
+    def similar_index(self):
+        """Return a HammingIndex of the perceptual hashes of all images.
+
+        The index is loaded on first use, and updated by later inserts.
+        """
+        if self._similar is None:
+            index = HammingIndex()
+            for chksum, value in self.dhashes():
+                index.add(value, chksum)
+            self._similar = index
+        return self._similar
+
+
+    def dhashes(self):
+        """Yield the (checksum, perceptual hash) of all images that have one.
+        """
+        cur = self.conn.cursor()
+        cur.execute('select md5, dhash from metadata where dhash is not null')
+        for chksum, value in cur:
+            yield chksum, from_signed(value)
+        return
+
+
+    def store_dhash(self, pairs):
+        """Record the perceptual hashes of (checksum, hash) pairs.
+
+        Only checksums whose metadata is cached are updated.
+        """
+        pairs = [(x[0], x[1]) for x in pairs if x[1] is not None]
+        cur = self.conn.cursor()
+        cur.executemany('update metadata set dhash = ? where md5 = ?',
+            [(to_signed(x[1]), x[0]) for x in pairs])
+        if self._similar is not None:
+            for chksum, value in pairs:
+                self._similar.add(value, chksum)
+        self._inserted(len(pairs))
+
+
+    def query_similar(self, value, maxdist=None):
+        """Return the (distance, checksum) of images near a perceptual hash.
+
+        The default distance is similar_distance.  Results are sorted by
+        distance.
+        """
+        if maxdist is None:
+            maxdist = self.similar_distance
+        if (value is None) or (maxdist is None):
+            return []
+        return self.similar_index().search(value, maxdist)
+
+
+    def missing_dhash(self):
+        """Return the (checksum, path) of indexed images without a
+        perceptual hash.
+        """
+        cur = self.conn.cursor()
+        cur.execute('select media.md5, media.path from media left join '
+            'metadata on media.md5 = metadata.md5 where metadata.dhash is '
+            'null and media.path is not null')
+        return [(x[0], os.path.join(self.root, x[1])) for x in cur if \
+            media_kind(x[1]) == "image"]
+
+
+    def uncached(self):
+        """Return the set of checksums whose metadata is not cached.
+        """
+        cur = self.conn.cursor()
+        cur.execute('select media.md5 from media left join metadata on '
+            'media.md5 = metadata.md5 where metadata.md5 is null')
+        return set([x[0] for x in cur])
+
+
+    def cached_meta(self, chksum):
+        """Return the cached exiftool metadata of a checksum, or None.
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute('select meta from metadata where md5 = ?',
+                (chksum,))
+        except sqlite3.OperationalError:
+            # An old DB opened read-only.
+            return None
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+
+    def cached_info(self, chksum):
+        """Return the promoted metadata columns of a checksum as a dict.
+        """
+        cur = self.conn.cursor()
+        try:
+            cur.execute('select {} from metadata where md5 = ?'.format(
+                ", ".join(metadata_columns[:-1])), (chksum,))
+        except sqlite3.OperationalError:
+            return None
+        row = cur.fetchone()
+        if row is None:
+            return None
+        ret = dict(zip(metadata_columns[:-1], row))
+        ret["dhash"] = from_signed(ret["dhash"])
+        return ret
+
+
+    def cached_object(self, path, st=None, file_time=False):
+        """Load an Image or Video from the DB without reading the file.
+
+        The file must be indexed at this path, with the same size, mtime
+        and inode as when it was indexed, and its metadata must be cached.
+        Otherwise None is returned.
+        """
+        kind = media_kind(path)
+        if kind is None:
+            return None
+        cur = self.conn.cursor()
+        try:
+            cur.execute('select media.md5, size, mtime, inode, hashalg, '
+                'meta from media join metadata on media.md5 = metadata.md5 '
+                'where path = ?', (self.relpath(path),))
+        except sqlite3.OperationalError:
+            return None
+        row = cur.fetchone()
+        if row is None:
+            return None
+        if st is None:
+            st = os.stat(path)
+        if row[1:4] != (st.st_size, st.st_mtime_ns, st.st_ino):
+            return None
+        meta = json.loads(zlib.decompress(row[5]).decode("utf-8"))
+        cls = Image
+        if kind == "video":
+            cls = Video
+        return cls(path, file_time=file_time, meta=meta, md5=row[0], st=st,
+            hashalg=row[4])
+
+
+    def update_stat(self, chksum, path, st, fprint=None):
+        """Record the current location and stat of the file with a checksum.
+        """
+        cur = self.conn.cursor()
+        cur.execute('update media set path = ?, size = ?, mtime = ?, '
+            'inode = ?, fprint = coalesce(?, fprint) where md5 = ?',
+            (self.relpath(path), st.st_size, st.st_mtime_ns, st.st_ino,
+            fprint, chksum))
+        self._inserted(1)
+
+
+    def delete_paths(self, relpaths):
+        """Remove the rows of files (given relative to the root).
+        """
+        cur = self.conn.cursor()
+        cur.executemany('delete from media where path = ?',
+            [(x,) for x in relpaths])
+        self._digests = None
+        self._inserted(len(relpaths))
+
+
+    def delete_unlocated(self):
+        """Remove rows that have no recorded path.
+        """
+        cur = self.conn.cursor()
+        cur.execute('delete from media where path is null')
+        if cur.rowcount > 0:
+            self._digests = None
+        self._inserted(cur.rowcount)
+
+
+    def stat_index(self):
+        """Return a dictionary of the stat signature of every indexed file.
+
+        The keys are paths relative to the root and the values are tuples
+        of (md5, size, mtime, inode, fprint, hashalg).
+        """
+        cur = self.conn.cursor()
+        cur.execute('select path, md5, size, mtime, inode, fprint, hashalg '
+            'from media where path is not null')
+        ret = dict()
+        for row in cur:
+            ret[row[0]] = tuple(row[1:])
+        return ret
+
+
+    def journal_record(self, path, st, chksum, output, state,
+        file_time=False):
+        """Record the import state of an input file.
+
+        file_time is the option the file is imported with, so that an
+        interrupted import is repaired with the same date.  A "planned"
+        entry is committed right away, so that it survives a crash during
+        the copy that follows.  Other states are committed with the
+        inserts.
+        """
+        if state not in journal_states:
+            raise RuntimeError("unknown journal state {}".format(state))
+        cur = self.conn.cursor()
+        cur.execute('insert or replace into journal (input, size, mtime, '
+            'inode, md5, output, state, file_time) values (?, ?, ?, ?, ?, '
+            '?, ?, ?)', (os.path.abspath(path), st.st_size, st.st_mtime_ns,
+            st.st_ino, chksum, output, state, int(bool(file_time))))
+        if state == "planned":
+            self.commit()
+        else:
+            self._inserted(1)
+
+
+    def journal_plan(self, entries):
+        """Record a group of imports as planned, in one commit.
+
+        entries are (path, stat, checksum, output, file_time) tuples.
+        """
+        if len(entries) == 0:
+            return
+        cur = self.conn.cursor()
+        cur.executemany('insert or replace into journal (input, size, '
+            'mtime, inode, md5, output, state, file_time) values (?, ?, ?, '
+            "?, ?, ?, 'planned', ?)", [(os.path.abspath(x[0]), x[1].st_size,
+            x[1].st_mtime_ns, x[1].st_ino, x[2], x[3], int(bool(x[4]))) \
+            for x in entries])
+        self.commit()
+
+
+    def journal_state(self, path, state):
+        """Move the journal entry of an input file to a new state.
+        """
+        if state not in journal_states:
+            raise RuntimeError("unknown journal state {}".format(state))
+        cur = self.conn.cursor()
+        cur.execute('update journal set state = ? where input = ?',
+            (state, os.path.abspath(path)))
+        self._inserted(1)
+
+
+    def journal_done(self, path, st):
+        """Return True if an unchanged input file was already imported.
+
+        The file must have been committed with the same size, mtime and
+        inode, and its checksum must still be in the media table.
+        """
+        cur = self.conn.cursor()
+        cur.execute('select journal.size, journal.mtime, journal.inode from '
+            'journal join media on journal.md5 = media.md5 where input = ? '
+            "and state = 'committed'", (os.path.abspath(path),))
+        row = cur.fetchone()
+        if row is None:
+            return False
+        return tuple(row) == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+    def journal_pending(self):
+        """Return the (input, checksum, output, state, file_time) of
+        interrupted imports.
+        """
+        cur = self.conn.cursor()
+        cur.execute("select input, md5, output, state, file_time from "
+            "journal where state != 'committed'")
+        return [tuple(x[0:4]) + (bool(x[4]),) for x in cur]
+
+
+    def journal_forget(self, path):
+        cur = self.conn.cursor()
+        cur.execute('delete from journal where input = ?',
+            (os.path.abspath(path),))
+        self._inserted(1)
+
+
+    def journal_clear(self):
+        """Forget all journal entries.
+        """
+        cur = self.conn.cursor()
+        cur.execute('delete from journal')
+        self._inserted(cur.rowcount)
+
+
+    def album_add(self, album, uids):
+        """Record media, given by uid, as members of an album.
+        """
+        cur = self.conn.cursor()
+        cur.executemany('insert or ignore into albums values (?, ?)',
+            [(album, x) for x in uids])
+        self._inserted(max(cur.rowcount, 0))
+
+
+    def album_remove(self, album, uids=None):
+        """Remove members from an album, or the whole album if uids is None.
+        """
+        cur = self.conn.cursor()
+        if uids is None:
+            cur.execute('delete from albums where album = ?', (album,))
+        else:
+            cur.executemany('delete from albums where album = ? and uid = ?',
+                [(album, x) for x in uids])
+        self._inserted(max(cur.rowcount, 0))
+
+
+    def albums(self):
+        """Return the names of all albums.
+        """
+        cur = self.conn.cursor()
+        cur.execute('select distinct album from albums order by album')
+        return [x[0] for x in cur]
+
+
+    def album_paths(self, album):
+        """Return the paths of the located members of an album, relative to
+        the root of the media tree, in sorted order.
+        """
+        cur = self.conn.cursor()
+        cur.execute('select media.path from albums join media on albums.uid '
+            '= media.uid where albums.album = ? and media.path is not null '
+            'order by media.path', (album,))
+        return [x[0] for x in cur]
+
+
+    def merge(self, path):
+        """Bulk insert the rows of another DB of the same media tree, such
+        as the DB of one shard.
+
+        Rows are checked as imports check files:  a row whose checksum is
+        already here is a duplicate and is skipped, and a row whose uid is
+        here with another checksum is a conflict.  If there is any
+        conflict, nothing is inserted.  Cached metadata is copied along.
+        Returns the number of rows inserted, the (path, existing path) of
+        the duplicates and the (path, existing path) of the conflicts.
+        """
+        self.commit()
+        cur = self.conn.cursor()
+        cur.execute('attach database ? as shard', (path,))
+        try:
+            cur.execute('pragma shard.user_version')
+            version = cur.fetchone()[0]
+            if version != schema_version:
+                raise RuntimeError("DB {} has schema version {}, not {}.  "
+                    "Open it for writing first to upgrade it.".format(path,
+                    version, schema_version))
+            cur.execute("select value from shard.settings where key = "
+                "'hashalg'")
+            row = cur.fetchone()
+            hashalg = 'md5' if row is None else row[0]
+            if hashalg != self.hashalg:
+                self.set_hashalg(hashalg)
+
+            cur.execute('select s.path, m.path from shard.media s join '
+                'main.media m on s.uid = m.uid where s.md5 != m.md5')
+            conflicts = [tuple(x) for x in cur]
+            # Rows of the same file at the same path were merged before.
+            cur.execute('select s.path, m.path from shard.media s join '
+                'main.media m on s.md5 = m.md5 where s.path is not m.path')
+            duplicates = [tuple(x) for x in cur]
+            if len(conflicts) > 0:
+                return 0, duplicates, conflicts
+
+            cols = ", ".join(media_columns)
+            cur.execute('insert or ignore into main.media ({0}) select {0} '
+                'from shard.media'.format(cols))
+            inserted = max(cur.rowcount, 0)
+            cols = ", ".join(metadata_columns)
+            cur.execute('insert or ignore into main.metadata ({0}) select '
+                '{0} from shard.metadata'.format(cols))
+            self.conn.commit()
+        finally:
+            self.conn.rollback()
+            cur.execute('detach database shard')
+        self._sizes = None
+        self._similar = None
+        self._digests = None
+        return inserted, duplicates, conflicts
+
+
+    def commit(self):
+        """Commit all pending inserts.
+        """
+        if self.conn is not None:
+            with stage("db_commit", items=self._pending):
+                self.conn.commit()
+        self._pending = 0
+
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
 
 
     def query(self, uid):
         cur = self.conn.cursor()
-        cur.execute('select * from media where uid = \"{}\"'.format(uid))
+        cur.execute('select * from media where uid = ?', (uid,))
         row = cur.fetchone()
         if row is None:
             return None
@@ -62,9 +728,27 @@ class DB(object):
             return tuple(row)
 
 
+    def preload_digests(self):
+        """Load all checksums into memory for fast duplicate checks.
+
+        After this, query_md5 is answered from a DigestSet, which later
+        inserts keep current, instead of a query per file.  The checksums
+        are read in the order of the unique index, so no sort is needed.
+        Returns the DigestSet.
+        """
+        if self._digests is None:
+            cur = self.conn.cursor()
+            cur.execute('select md5 from media where md5 is not null order '
+                'by md5')
+            self._digests = DigestSet(x[0] for x in cur)
+        return self._digests
+
+
     def query_md5(self, chksum):
+        if self._digests is not None:
+            return (chksum in self._digests)
         cur = self.conn.cursor()
-        cur.execute('select * from media where md5 = \"{}\"'.format(chksum))
+        cur.execute('select * from media where md5 = ?', (chksum,))
         row = cur.fetchone()
         if row is None:
             return False
@@ -72,6 +756,130 @@ class DB(object):
             return True
 
 
+    def query_md5_row(self, chksum):
+        cur = self.conn.cursor()
+        cur.execute('select * from media where md5 = ?', (chksum,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        else:
+            return tuple(row)
+
+
+    def sizes(self):
+        """Return the set of file sizes in the DB.
+
+        If some rows do not have a size yet, the set contains None.
+        """
+        if self._sizes is None:
+            cur = self.conn.cursor()
+            cur.execute('select distinct size from media')
+            self._sizes = set([x[0] for x in cur])
+        return self._sizes
+
+
+    def query_fprint(self, size, fprint):
+        """Return True if some file might have this size and fingerprint.
+
+        Rows that do not have a size or fingerprint yet (indexed before
+        they were recorded) match any size or fingerprint.
+        """
+        cur = self.conn.cursor()
+        cur.execute('select 1 from media where (size = ? or size is null) '
+            'and (fprint = ? or fprint is null) limit 1', (size, fprint))
+        return (cur.fetchone() is not None)
+
+
+    def _date_cond(self, op, date):
+        # A row value comparison on a prefix of the date index.
+        date = tuple([int(x) for x in date])
+        if (len(date) < 1) or (len(date) > len(date_columns)):
+            raise RuntimeError("invalid date {}".format(date))
+        cols = ", ".join(["media.{}".format(x) for x in \
+            date_columns[0:len(date)]])
+        marks = ", ".join(["?"] * len(date))
+        if len(date) == 1:
+            return 'media.year {} ?'.format(op), list(date)
+        return '({}) {} ({})'.format(cols, op, marks), list(date)
+
+
+    def select(self, since=None, until=None, make=None, model=None,
+        kind=None, columns=None, limit=None):
+        """Stream the rows of all media matching the given conditions.
+
+        since and until are (year, month, day, hour, minute, second) tuples,
+        which may be truncated after any element:  both are inclusive at
+        their precision, so since=(2019, 6) and until=(2019, 6) selects June
+        2019.  make and model select the camera, and may contain "*" and "?"
+        wildcards.  kind is "image" or "video".  Rows are tuples of the
+        given media columns (default:  all of media_columns), ordered by
+        date, and are read from the cursor as the caller iterates.
+        """
+        if columns is None:
+            columns = media_columns
+        conds = list()
+        params = list()
+        if since is not None:
+            cond, par = self._date_cond(">=", since)
+            conds.append(cond)
+            params.extend(par)
+        if until is not None:
+            cond, par = self._date_cond("<=", until)
+            conds.append(cond)
+            params.extend(par)
+        join = ''
+        for col, val in (('make', make), ('model', model)):
+            if val is None:
+                continue
+            join = ' join metadata on media.md5 = metadata.md5'
+            if ('*' in val) or ('?' in val):
+                conds.append('metadata.{} glob ?'.format(col))
+            else:
+                conds.append('metadata.{} = ?'.format(col))
+            params.append(val)
+        sql = 'select {}, media.name from media{}'.format(", ".join(
+            ["media.{}".format(x) for x in columns]), join)
+        if len(conds) > 0:
+            sql += ' where ' + ' and '.join(conds)
+        sql += ' order by {}'.format(", ".join(["media.{}".format(x) for x \
+            in date_columns]))
+        if (limit is not None) and (kind is None):
+            sql += ' limit ?'
+            params.append(int(limit))
+        cur = self.conn.cursor()
+        cur.execute(sql, params)
+        count = 0
+        for row in cur:
+            if (kind is not None) and (media_kind(row[-1]) != kind):
+                continue
+            yield tuple(row[:-1])
+            count += 1
+            if (limit is not None) and (count >= limit):
+                break
+        cur.close()
+        return
+
+
+    def select_paths(self, **kwargs):
+        """Stream the absolute paths of the media matching select(**kwargs).
+        """
+        for row in self.select(columns=['path'], **kwargs):
+            if row[0] is not None:
+                yield os.path.join(self.root, row[0])
+        return
+
+
+    def query_path(self, path):
+        cur = self.conn.cursor()
+        cur.execute('select * from media where path = ?',
+            (self.relpath(path),))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        else:
+            return tuple(row)
+
+
 
 if __name__ == "__main__":
 
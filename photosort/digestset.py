@@ -0,0 +1,217 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import bisect
+
+
+# Number of digests converted at once while loading.
+load_chunk = 65536
+
+# Digests added after construction are folded into the packed arrays once
+# there are this many, so that memory stays at about width bytes each.
+merge_pending = 65536
+
+
+class _Prefixes(object):
+    # The 16 bit prefixes of the records of a packed table, as a sequence
+    # for bisect.
+
+    def __init__(self, data, width):
+        self.data = data
+        self.width = width
+
+    def __len__(self):
+        return len(self.data) // self.width
+
+    def __getitem__(self, indx):
+        off = indx * self.width
+        return (self.data[off] << 8) | self.data[off + 1]
+
+
+class _Table(object):
+    # Sorted raw digests of one width, packed into a single bytearray, and
+    # the index of the first record of each 16 bit prefix.
+
+    __slots__ = ("width", "data", "offsets")
+
+    def __init__(self, width, data=None):
+        self.width = width
+        if data is None:
+            data = bytearray()
+        self.data = data
+        self.offsets = None
+
+    @property
+    def count(self):
+        return len(self.data) // self.width
+
+    def finish(self):
+        seq = _Prefixes(self.data, self.width)
+        self.offsets = [bisect.bisect_left(seq, p) for p in range(65536)]
+        self.offsets.append(len(seq))
+
+    def _bucket(self, prefix):
+        w = self.width
+        return [bytes(self.data[off:off+w]) for off in \
+            range(self.offsets[prefix] * w, self.offsets[prefix + 1] * w, w)]
+
+    def insert(self, raws):
+        """Insert new raw digests, keeping the records sorted.
+
+        Only the buckets which get new records are unpacked;  the rest of
+        the array is copied in slices.
+        """
+        w = self.width
+        groups = dict()
+        for raw in raws:
+            groups.setdefault((raw[0] << 8) | raw[1], list()).append(raw)
+        data = bytearray()
+        pos = 0
+        for prefix in sorted(groups):
+            start = self.offsets[prefix] * w
+            data += self.data[pos:start]
+            recs = self._bucket(prefix) + groups[prefix]
+            recs.sort()
+            data += b"".join(recs)
+            pos = self.offsets[prefix + 1] * w
+        data += self.data[pos:]
+        added = 0
+        for prefix in range(65536):
+            added += len(groups.get(prefix, ()))
+            self.offsets[prefix + 1] += added
+        self.data = data
+
+    def __contains__(self, raw):
+        prefix = (raw[0] << 8) | raw[1]
+        w = self.width
+        start = self.offsets[prefix] * w
+        end = self.offsets[prefix + 1] * w
+        # Search the bucket at C speed, and skip matches which straddle two
+        # records.
+        pos = self.data.find(raw, start, end)
+        while (pos >= 0) and ((pos - start) % w != 0):
+            pos = self.data.find(raw, pos + 1, end)
+        return (pos >= 0)
+
+
+def _raw(hx):
+    # The raw bytes of a lower case hex digest, or None for anything else.
+    try:
+        raw = bytes.fromhex(hx)
+    except (ValueError, TypeError):
+        return None
+    if (len(raw) < 2) or (raw.hex() != hx):
+        return None
+    return raw
+
+
+class DigestSet(object):
+    """A compact set of hex digests, for duplicate checks in memory.
+
+    The digests given to the constructor must be sorted (as the unique
+    index of the media table returns them).  They are stored as raw bytes,
+    packed into one array per digest width, with an index of their 16 bit
+    prefixes:  ten million md5 sums take about 160MB, instead of more than
+    a gigabyte for a set of strings.  A lookup searches one bucket of (on
+    average) count / 65536 records with bytearray.find.  Digests added
+    later go to a small set, which is folded into the packed arrays by
+    merge(), and automatically once it holds merge_pending digests.
+    """
+
+    def __init__(self, digests=()):
+        self._tables = dict()
+        self._pending = set()
+        self._other = set()
+        chunk = list()
+        for hx in digests:
+            chunk.append(hx)
+            if len(chunk) >= load_chunk:
+                self._load(chunk)
+                chunk = list()
+        self._load(chunk)
+        for tab in self._tables.values():
+            tab.finish()
+
+    def _table(self, width):
+        tab = self._tables.get(width, None)
+        if tab is None:
+            tab = _Table(width)
+            self._tables[width] = tab
+        return tab
+
+    def _load(self, chunk):
+        if len(chunk) == 0:
+            return
+        # Convert a chunk of canonical digests of one width in one go.
+        nchar = len(chunk[0])
+        if (nchar >= 4) and all([len(x) == nchar for x in chunk]):
+            joined = "".join(chunk)
+            try:
+                raw = bytes.fromhex(joined)
+            except ValueError:
+                raw = None
+            if (raw is not None) and (raw.hex() == joined):
+                self._table(nchar // 2).data.extend(raw)
+                return
+        for hx in chunk:
+            raw = _raw(hx)
+            if raw is None:
+                self._other.add(hx)
+            else:
+                self._table(len(raw)).data.extend(raw)
+        return
+
+    def __len__(self):
+        return sum([x.count for x in self._tables.values()]) + \
+            len(self._pending) + len(self._other)
+
+    def __contains__(self, hx):
+        raw = _raw(hx)
+        if raw is None:
+            return hx in self._other
+        if raw in self._pending:
+            return True
+        tab = self._tables.get(len(raw), None)
+        if tab is None:
+            return False
+        return raw in tab
+
+    def add(self, hx):
+        raw = _raw(hx)
+        if raw is None:
+            self._other.add(hx)
+            return
+        tab = self._tables.get(len(raw), None)
+        if (tab is not None) and (raw in tab):
+            return
+        self._pending.add(raw)
+        if len(self._pending) >= merge_pending:
+            self.merge()
+
+    def merge(self):
+        """Fold the digests added since construction into the packed arrays.
+        """
+        if len(self._pending) == 0:
+            return
+        widths = set([len(x) for x in self._pending])
+        for w in widths:
+            raws = [x for x in self._pending if len(x) == w]
+            tab = self._tables.get(w, None)
+            if tab is None:
+                raws.sort()
+                tab = _Table(w, bytearray(b"".join(raws)))
+                tab.finish()
+                self._tables[w] = tab
+            else:
+                tab.insert(raws)
+        self._pending = set()
+
+    @property
+    def nbytes(self):
+        """Approximate memory use in bytes.
+        """
+        ret = 0
+        for tab in self._tables.values():
+            ret += len(tab.data) + 8 * len(tab.offsets)
+        ret += 100 * (len(self._pending) + len(self._other))
+        return ret
@@ -0,0 +1,331 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import json
+import time
+import select
+import atexit
+import threading
+import subprocess as sp
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class ExifToolError(RuntimeError):
+    pass
+
+
+class ExifTool(object):
+    """A single exiftool process kept alive with the -stay_open protocol.
+
+    Arguments are written to the process one per line, followed by an
+    "-execute{N}" line.  The output of that command is everything up to
+    the "{readyN}" line.  An instance must only be used by one thread at
+    a time.
+    """
+
+    def __init__(self, executable="exiftool", merge_stderr=False):
+        self.executable = executable
+        self.merge_stderr = merge_stderr
+        self.proc = None
+        self._count = 0
+
+    def start(self):
+        if self.running():
+            return
+        stderr = sp.DEVNULL
+        if self.merge_stderr:
+            stderr = sp.STDOUT
+        try:
+            self.proc = sp.Popen([self.executable, "-stay_open", "True",
+                "-@", "-"], stdin=sp.PIPE, stdout=sp.PIPE, stderr=stderr)
+        except OSError as e:
+            self.proc = None
+            raise ExifToolError("cannot start {}: {}".format(
+                self.executable, e))
+        return
+
+    def running(self):
+        return (self.proc is not None) and (self.proc.poll() is None)
+
+    def close(self, kill=False):
+        if self.proc is None:
+            return
+        if (not kill) and (self.proc.poll() is None):
+            try:
+                self.proc.stdin.write(b"-stay_open\nFalse\n")
+                self.proc.stdin.flush()
+                self.proc.wait(timeout=5.0)
+            except Exception:
+                kill = True
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        for f in (self.proc.stdin, self.proc.stdout):
+            try:
+                f.close()
+            except Exception:
+                pass
+        self.proc = None
+        return
+
+    def execute(self, args, timeout=None):
+        """Run one exiftool command and return its raw output bytes.
+
+        If the command does not finish within timeout seconds, or the
+        process dies, the process is killed and ExifToolError is raised.
+        """
+        for a in args:
+            if "\n" in a:
+                raise ExifToolError("argument {!r} contains a newline"\
+                    .format(a))
+        self.start()
+        self._count += 1
+        sentinel = "{{ready{}}}".format(self._count).encode("utf-8")
+        lines = list(args)
+        lines.append("-execute{}".format(self._count))
+        payload = "".join(["{}\n".format(x) for x in lines])
+        try:
+            self.proc.stdin.write(payload.encode("utf-8"))
+            self.proc.stdin.flush()
+        except (OSError, ValueError) as e:
+            self.close(kill=True)
+            raise ExifToolError("exiftool process died: {}".format(e))
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        fd = self.proc.stdout.fileno()
+        buf = bytearray()
+        while True:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    self.close(kill=True)
+                    raise ExifToolError("exiftool timed out after {:.1f}s"\
+                        .format(timeout))
+            ready, _, _ = select.select([fd], [], [], wait)
+            if len(ready) == 0:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                self.close(kill=True)
+                raise ExifToolError("exiftool process exited unexpectedly")
+            # Only search the tail that could contain a new sentinel.
+            start = max(0, len(buf) - len(sentinel))
+            buf.extend(chunk)
+            pos = buf.find(sentinel, start)
+            if pos >= 0:
+                return bytes(buf[:pos])
+
+
+def parse_json(output, filenames):
+    """Map the output of "exiftool -j" back onto a list of files.
+
+    Files that exiftool could not read get an empty dictionary, which
+    matches what file_json has always returned on failure.
+    """
+    bysource = {}
+    text = output.decode("utf-8", "replace").strip()
+    if text != "":
+        try:
+            records = json.loads(text)
+        except ValueError:
+            records = []
+        for rec in records:
+            if "SourceFile" in rec:
+                bysource[rec["SourceFile"]] = rec
+    return [bysource.get(f, {}) for f in filenames]
+
+
+class ExifToolPool(object):
+    """A thread-safe pool of persistent exiftool processes.
+
+    Requests are split into batches of at most batch_size files.  Each
+    batch is allowed timeout seconds per file.  If a batch fails (worker
+    crash or timeout), the worker is replaced and the files of that batch
+    are retried one at a time, so that a single bad file only loses its
+    own metadata.
+    """
+
+    def __init__(self, nworker=1, executable="exiftool", timeout=60.0,
+        batch_size=64, merge_stderr=False):
+        self.nworker = max(1, int(nworker))
+        self.executable = executable
+        self.merge_stderr = merge_stderr
+        self.timeout = timeout
+        self.batch_size = max(1, int(batch_size))
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._all = []
+        self._broken = False
+        # Workers checked out by running commands, and whether the pool
+        # was replaced and should close once they are all back.
+        self._busy = 0
+        self._retired = False
+
+    def _get(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._all) < self.nworker:
+                tool = ExifTool(executable=self.executable,
+                    merge_stderr=self.merge_stderr)
+                self._all.append(tool)
+                return tool
+        return self._idle.get()
+
+    def _acquire(self):
+        tool = self._get()
+        with self._lock:
+            self._busy += 1
+        return tool
+
+    def _release(self, tool):
+        self._idle.put(tool)
+        with self._lock:
+            self._busy -= 1
+            done = self._retired and (self._busy == 0)
+        if done:
+            self.close()
+        return
+
+    def retire(self):
+        """Close the workers as soon as no command is using them.
+        """
+        with self._lock:
+            self._retired = True
+            done = (self._busy == 0)
+        if done:
+            self.close()
+        return
+
+    def close(self):
+        with self._lock:
+            for tool in self._all:
+                tool.close()
+        return
+
+    def _execute(self, tool, args, timeout):
+        try:
+            return tool.execute(args, timeout=timeout)
+        except ExifToolError:
+            if not tool.running():
+                # Distinguish a missing executable from a crashed worker.
+                try:
+                    tool.start()
+                except ExifToolError:
+                    self._broken = True
+            raise
+
+    def execute(self, args, timeout=None):
+        """Run one command on a free worker and return its raw output.
+        """
+        if self._broken:
+            raise ExifToolError("cannot run {}".format(self.executable))
+        if timeout is None:
+            timeout = self.timeout
+        tool = self._acquire()
+        try:
+            return self._execute(tool, args, timeout)
+        finally:
+            self._release(tool)
+
+    def _batch(self, files):
+        if self._broken:
+            return [{} for f in files]
+        tool = self._acquire()
+        try:
+            args = ["-j", "-sort"]
+            args.extend(files)
+            try:
+                out = self._execute(tool, args, self.timeout * len(files))
+                return parse_json(out, files)
+            except ExifToolError as e:
+                if self._broken:
+                    return [{} for f in files]
+                if len(files) == 1:
+                    print("exiftool failed on {}: {}".format(files[0], e),
+                        file=sys.stderr)
+                    return [{}]
+        finally:
+            self._release(tool)
+        ret = []
+        for f in files:
+            ret.extend(self._batch([f]))
+        return ret
+
+    def json(self, filenames):
+        """Return the exiftool JSON dictionary of each file, in order."""
+        ret = []
+        bsize = self.batch_size
+        for off in range(0, len(filenames), bsize):
+            ret.extend(self._batch(list(filenames[off:off+bsize])))
+        return ret
+
+    def map(self, filenames):
+        """Like json(), but spread batches over all workers.
+        """
+        if (self.nworker == 1) or (len(filenames) <= self.batch_size):
+            return self.json(filenames)
+        # Use smaller batches so that every worker gets a share.
+        bsize = max(1, min(self.batch_size,
+            (len(filenames) + self.nworker - 1) // self.nworker))
+        batches = [list(filenames[off:off+bsize]) for off in \
+            range(0, len(filenames), bsize)]
+        # One thread per worker, each taking the next batch in turn.
+        ret = []
+        with ThreadPoolExecutor(max_workers=self.nworker) as tpool:
+            for r in tpool.map(self._batch, batches):
+                ret.extend(r)
+        return ret
+
+
+_pools = dict()
+_retired_pools = list()
+_pool_lock = threading.Lock()
+
+
+def exiftool_pool(nworker=None, writer=False, **kwargs):
+    """Return a shared pool, optionally resizing it.
+
+    There is one pool for reading metadata, and one for commands that
+    write files, whose workers also capture stderr so that errors can be
+    reported.  With nworker None the existing pool is returned as it is.
+    A pool that is replaced by one of another size is only closed once
+    the commands running on it are done, since other threads may still be
+    using it.
+    """
+    with _pool_lock:
+        pool = _pools.get(writer, None)
+        if (pool is not None) and (nworker is not None) and \
+            (nworker != pool.nworker):
+            pool.retire()
+            _retired_pools.append(pool)
+            pool = None
+        if pool is None:
+            if nworker is None:
+                nworker = 1
+            pool = ExifToolPool(nworker=nworker, merge_stderr=writer,
+                **kwargs)
+            _pools[writer] = pool
+    return pool
+
+
+def _close_pools():
+    for pool in list(_pools.values()) + _retired_pools:
+        pool.close()
+    return
+
+
+atexit.register(_close_pools)
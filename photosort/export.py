@@ -0,0 +1,193 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .media import Image, Video, media_kind
+
+from .exiftool import exiftool_pool
+
+from .hashing import file_drop_cache
+
+
+def _export(mediaroot, objfile, outroot, res, hashalg, manifest=None,
+    md5=None, meta=None, st=None, link="reflink", backend="auto",
+    preview=True):
+    # Export one file, or find its current output in the manifest.  Returns
+    # None for non-media files, otherwise a tuple of (output path, digest,
+    # effective resolution, True if the file was exported now).  The
+    # digest, metadata and stat are looked up or computed if not given.
+    absfile = os.path.abspath(objfile)
+    objdir = os.path.dirname(absfile)
+    if not objdir.startswith(mediaroot):
+        raise RuntimeError("file {} not in media directory {}"\
+            .format(absfile, mediaroot))
+    kind = media_kind(absfile)
+    if kind == "image":
+        cls = Image
+    elif kind == "video":
+        cls = Video
+        # Only full-size export supported for now...
+        res = "FULL"
+    else:
+        return None
+    obj = cls(absfile, md5=md5, meta=meta, st=st, hashalg=hashalg)
+    if manifest is not None:
+        outpath = manifest.current(obj.md5, res)
+        if outpath is not None:
+            # The file was only read (if at all) to check its digest.
+            if md5 is None:
+                file_drop_cache(absfile)
+            return (outpath, obj.md5, res, False)
+        # Replace a stale output instead of exporting next to it.
+        stale = manifest.recorded(obj.md5, res)
+        if (stale is not None) and os.path.isfile(stale):
+            os.remove(stale)
+    outdir = os.path.join(outroot, obj.year, obj.month, obj.day)
+    os.makedirs(outdir, exist_ok=True)
+    outpath = obj.export(outdir, resolution=res, link=link, backend=backend,
+        preview=preview)
+    return (outpath, obj.md5, res, True)
+
+
+def export_object(db, mediaroot, objfile, outroot, res, hashalg=None,
+    link="reflink", backend="auto", preview=True):
+    """Export one file of the media tree.
+
+    Returns the output path, or None if the file is not a media file.
+    When called from a worker thread, pass the hashalg of the DB, since
+    the DB connection can only be used by the thread that opened it.
+    """
+    if hashalg is None:
+        hashalg = db.hashalg
+    ret = _export(mediaroot, objfile, outroot, res, hashalg, link=link,
+        backend=backend, preview=preview)
+    if ret is None:
+        return None
+    return ret[0]
+
+
+class ExportStats(object):
+    """Counters for a batch of exports.
+    """
+
+    def __init__(self, total):
+        self.start = time.time()
+        self.total = total
+        self.done = 0
+        self.exported = 0
+        self.current = 0
+        self.skipped = 0
+        self.failed = list()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def summary(self):
+        elapsed = max(time.time() - self.start, 1.0e-6)
+        lines = list()
+        lines.append("Exported {} of {} files in {:.1f}s ({:.1f} files/s, "
+            "{:.2f}MB/s read, {:.2f}MB written)".format(self.exported,
+            self.total, elapsed, self.exported / elapsed,
+            self.bytes_in / 1.0e6 / elapsed, self.bytes_out / 1.0e6))
+        if self.current > 0:
+            lines.append("  {} files already up to date".format(
+                self.current))
+        if self.skipped > 0:
+            lines.append("  {} files skipped".format(self.skipped))
+        if len(self.failed) > 0:
+            lines.append("  {} exports FAILED:".format(len(self.failed)))
+            for path, err in self.failed:
+                lines.append("    {}: {}".format(path, err))
+        return "\n".join(lines)
+
+
+def export_files(db, mediaroot, files, outroot, res, jobs=1, manifest=None,
+    link="reflink", backend="auto", preview=True):
+    """Export many files of the media tree concurrently.
+
+    At most jobs exports run at once, and each export runs its external
+    tools (dcraw | convert, then exiftool) one after the other, so this
+    also bounds the number of external processes.  Progress is printed as
+    jobs finish, and failures are collected instead of stopping the run.
+
+    The digests and metadata of files that are unchanged since they were
+    indexed are taken from the DB.  If an ExportManifest is given, files
+    whose output from a previous run is unchanged are skipped without
+    reading them, and new outputs are recorded in it.  Returns the
+    ExportStats.
+    """
+    jobs = max(1, int(jobs))
+    exiftool_pool(jobs)
+    exiftool_pool(jobs, writer=True)
+    stats = ExportStats(len(files))
+    hashalg = db.hashalg
+    known = db.stat_index()
+
+    def run(path, md5, meta, st):
+        return _export(mediaroot, path, outroot, res, hashalg,
+            manifest=manifest, md5=md5, meta=meta, st=st, link=link,
+            backend=backend, preview=preview)
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = dict()
+        for path in files:
+            # The DB can only be used from this thread, so look up what it
+            # knows about the file here.
+            md5 = None
+            meta = None
+            st = None
+            kind = media_kind(path)
+            if kind is not None:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    st = None
+            if st is not None:
+                row = known.get(db.relpath(path), None)
+                if (row is not None) and (row[5] == hashalg) and \
+                    (row[1:4] == (st.st_size, st.st_mtime_ns, st.st_ino)):
+                    md5 = row[0]
+            if md5 is not None:
+                outres = res
+                if kind == "video":
+                    outres = "FULL"
+                if (manifest is not None) and \
+                    (manifest.current(md5, outres) is not None):
+                    stats.done += 1
+                    stats.current += 1
+                    continue
+                meta = db.cached_meta(md5)
+            futures[pool.submit(run, path, md5, meta, st)] = path
+        for fut in as_completed(futures):
+            path = futures[fut]
+            stats.done += 1
+            prefix = "[{}/{}]".format(stats.done, stats.total)
+            try:
+                ret = fut.result()
+            except Exception as e:
+                stats.failed.append((path, str(e)))
+                print("{} FAILED {}: {}".format(prefix, path, e), flush=True)
+                continue
+            if ret is None:
+                stats.skipped += 1
+                print("{} Skipping non-media file {}".format(prefix, path),
+                    flush=True)
+                continue
+            outpath, digest, outres, fresh = ret
+            if not fresh:
+                stats.current += 1
+                continue
+            if manifest is not None:
+                manifest.update(digest, outres, outpath)
+            stats.exported += 1
+            stats.bytes_in += os.path.getsize(path)
+            stats.bytes_out += os.path.getsize(outpath)
+            print("{} Exported {} to {}".format(prefix, path, outpath),
+                flush=True)
+    if manifest is not None:
+        manifest.commit()
+    return stats
@@ -0,0 +1,265 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import mmap
+import time
+import hashlib
+import threading
+import queue
+
+from .instrument import stage
+
+
+# The digest algorithms a library can use.  BLAKE2b is truncated to 16
+# bytes, so that its hex digest has the same length as an md5 sum.
+hash_algorithms = ["md5", "blake2b", "sha256"]
+
+default_blocksize = 2**20
+
+# Files at least this large are read by a background thread while the
+# caller hashes, when read-ahead is enabled.  For smaller files starting
+# the thread costs more than the overlap gains.
+readahead_min = 2**23
+
+# Number of blocks the reader thread may get ahead of the hashing.
+readahead_buffers = 2
+
+# Size of the first and last blocks of a file that make its fingerprint.
+fingerprint_blocksize = 2**16
+
+
+def _advise(fd, offset, length, advice):
+    # posix_fadvise is only a hint, and not available everywhere (or on
+    # every file system), so errors are ignored.
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except (OSError, AttributeError):
+        pass
+    return
+
+
+def new_hash(algorithm="md5"):
+    if algorithm == "md5":
+        return hashlib.md5()
+    elif algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    elif algorithm == "sha256":
+        return hashlib.sha256()
+    else:
+        raise RuntimeError("unsupported hash algorithm {}".format(algorithm))
+
+
+def fingerprint_hash(size, head, tail):
+    """The fingerprint of a file from its size and first and last blocks.
+    """
+    m = hashlib.md5()
+    m.update("{:d}:".format(size).encode("ascii"))
+    m.update(head)
+    if size > fingerprint_blocksize:
+        m.update(tail)
+    return m.hexdigest()
+
+
+class _FingerprintTap(object):
+    # Passes the blocks of a file on to a hash object, and keeps the parts
+    # that make its fingerprint, so that both come from one read.
+
+    def __init__(self, h, size):
+        self.h = h
+        self.size = size
+        self.offset = 0
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.tail_start = max(fingerprint_blocksize,
+            size - fingerprint_blocksize)
+
+    def update(self, data):
+        self.h.update(data)
+        n = len(data)
+        off = self.offset
+        if off < fingerprint_blocksize:
+            self.head += data[0:fingerprint_blocksize - off]
+        if off + n > self.tail_start:
+            self.tail += data[max(0, self.tail_start - off):]
+        self.offset = off + n
+
+    def fingerprint(self):
+        return fingerprint_hash(self.size, self.head, self.tail)
+
+
+def _digest_read(f, h, blocksize):
+    # Read into one reused buffer, instead of a new bytes object per block.
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    while True:
+        n = f.readinto(buf)
+        if not n:
+            break
+        h.update(view[:n])
+    return
+
+
+def _digest_readahead(f, h, blocksize, nbuffers=readahead_buffers):
+    # A reader thread fills a small ring of buffers while this thread
+    # hashes the previous ones.  Both file reads and hash updates of large
+    # buffers release the GIL, so the disk and the CPU work in parallel.
+    fd = f.fileno()
+    free = queue.Queue()
+    full = queue.Queue()
+    for i in range(nbuffers):
+        free.put(bytearray(blocksize))
+
+    def reader():
+        try:
+            offset = 0
+            while True:
+                buf = free.get()
+                if buf is None:
+                    # Cancelled by the hashing side.
+                    return
+                n = f.readinto(buf)
+                full.put((buf, n))
+                if not n:
+                    return
+                offset += n
+                # Start reading the blocks after the ones in flight.
+                _advise(fd, offset, nbuffers * blocksize,
+                    "POSIX_FADV_WILLNEED")
+        except BaseException as e:
+            full.put((None, e))
+        return
+
+    thread = threading.Thread(target=reader, name="readahead")
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            buf, n = full.get()
+            if buf is None:
+                raise n
+            if not n:
+                break
+            h.update(memoryview(buf)[:n])
+            free.put(buf)
+    finally:
+        free.put(None)
+        thread.join()
+    return
+
+
+def _digest_mmap(f, h, blocksize):
+    size = os.fstat(f.fileno()).st_size
+    if size == 0:
+        return
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mm)
+        try:
+            for off in range(0, size, blocksize):
+                h.update(view[off:off+blocksize])
+        finally:
+            view.release()
+    finally:
+        mm.close()
+    return
+
+
+def file_digest(filename, algorithm="md5", blocksize=default_blocksize,
+    use_mmap=False, readahead=True, drop_cache=False, fingerprint=False):
+    """Compute the hex digest of a file.
+
+    The kernel is told that the file is read sequentially.  With readahead,
+    files of at least readahead_min bytes are read by a background thread
+    (double buffered) while the digest is computed, which keeps slow or
+    network disks busy.  With drop_cache, the pages of the file are
+    dropped from the page cache afterwards, so that hashing files which
+    are not needed again does not evict more useful data.  With
+    fingerprint, (digest, fingerprint) is returned, where the fingerprint
+    (see media.file_fingerprint) is taken from the same read.
+    """
+    h = new_hash(algorithm)
+    tap = None
+    with stage("digest") as t, open( filename, "rb", buffering=0 ) as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        if fingerprint:
+            tap = _FingerprintTap(h, size)
+            h = tap
+        _advise(fd, 0, 0, "POSIX_FADV_SEQUENTIAL")
+        if use_mmap:
+            _digest_mmap(f, h, blocksize)
+        elif readahead and (size >= readahead_min):
+            _advise(fd, 0, readahead_buffers * blocksize,
+                "POSIX_FADV_WILLNEED")
+            _digest_readahead(f, h, blocksize)
+        else:
+            _digest_read(f, h, blocksize)
+        if drop_cache:
+            _advise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+        t.add(nbytes=size)
+    if tap is not None:
+        return tap.h.hexdigest(), tap.fingerprint()
+    return h.hexdigest()
+
+
+def file_drop_cache(filename):
+    """Drop the pages of a file from the page cache.
+
+    This is for files that were read (for example hashed with file_digest)
+    before it was known that they are not needed again.
+    """
+    try:
+        fd = os.open(filename, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        _advise(fd, 0, 0, "POSIX_FADV_DONTNEED")
+    finally:
+        os.close(fd)
+    return
+
+
+def benchmark(filenames, algorithms=hash_algorithms,
+    blocksizes=[2**16, 2**20, 2**23], repeat=3):
+    """Time every algorithm / read method / block size on some files.
+
+    Returns a list of (algorithm, method, blocksize, MB/s), using the best
+    of repeat runs.  The first pass over the files warms the page cache, so
+    this measures hashing and copying overhead rather than the disk.
+    """
+    total = sum([os.path.getsize(x) for x in filenames])
+    for f in filenames:
+        file_digest(f)
+    results = list()
+    for alg in algorithms:
+        for method in ["readinto", "readahead", "mmap"]:
+            for bsize in blocksizes:
+                best = None
+                for r in range(repeat):
+                    start = time.time()
+                    for f in filenames:
+                        file_digest(f, algorithm=alg, blocksize=bsize,
+                            use_mmap=(method == "mmap"),
+                            readahead=(method == "readahead"))
+                    elapsed = time.time() - start
+                    if (best is None) or (elapsed < best):
+                        best = elapsed
+                rate = total / 1.0e6 / max(best, 1.0e-9)
+                results.append((alg, method, bsize, rate))
+    return results
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        print("usage: python -m photosort.hashing <file> [<file> ...]")
+        sys.exit(1)
+    for alg, method, bsize, rate in benchmark(sys.argv[1:]):
+        print("{:8s} {:9s} {:8d} {:10.1f} MB/s".format(alg, method, bsize,
+            rate))
@@ -0,0 +1,259 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import time
+import json
+import threading
+import atexit
+
+
+# Latency histograms have one bucket per power of two of microseconds, up
+# to about 18 minutes.
+histogram_buckets = 30
+
+_enabled = False
+_lock = threading.Lock()
+_stages = dict()
+_start = None
+
+
+class StageStats(object):
+    """Accumulated timings of one instrumented stage.
+    """
+
+    __slots__ = ("name", "calls", "items", "bytes", "seconds", "max",
+        "histogram")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.items = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.histogram = [0] * histogram_buckets
+
+    def add(self, seconds, nbytes, items):
+        self.calls += 1
+        self.items += items
+        self.bytes += nbytes
+        self.seconds += seconds
+        if seconds > self.max:
+            self.max = seconds
+        bucket = min(int(seconds * 1.0e6).bit_length(),
+            histogram_buckets - 1)
+        self.histogram[bucket] += 1
+
+    def percentile(self, frac):
+        """Upper bound in seconds of the given fraction of call latencies.
+        """
+        if self.calls == 0:
+            return 0.0
+        target = frac * self.calls
+        total = 0
+        for bucket, count in enumerate(self.histogram):
+            total += count
+            if total >= target:
+                return min((2 ** bucket) / 1.0e6, self.max)
+        return self.max
+
+    def report(self):
+        return {
+            "calls": self.calls,
+            "items": self.items,
+            "bytes": self.bytes,
+            "seconds": self.seconds,
+            "max_seconds": self.max,
+            "p50_seconds": self.percentile(0.5),
+            "p99_seconds": self.percentile(0.99),
+            "histogram_us": dict([(str(2 ** b), c) for b, c in \
+                enumerate(self.histogram) if c > 0]),
+        }
+
+
+class _Timer(object):
+
+    __slots__ = ("name", "nbytes", "items", "_start")
+
+    def __init__(self, name, nbytes, items):
+        self.name = name
+        self.nbytes = nbytes
+        self.items = items
+
+    def __bool__(self):
+        return True
+
+    def add(self, nbytes=0, items=0):
+        self.nbytes += nbytes
+        self.items += items
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        record(self.name, time.perf_counter() - self._start, self.nbytes,
+            self.items)
+        return False
+
+
+class _NullTimer(object):
+    # Returned by stage() while disabled.  It is false, so that callers can
+    # skip work that is only needed for the counters.
+
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def add(self, nbytes=0, items=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_null = _NullTimer()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(on=True):
+    """Start (or stop) collecting timings.
+    """
+    global _enabled, _start
+    if on and (_start is None):
+        _start = time.perf_counter()
+    _enabled = bool(on)
+    return
+
+
+def reset():
+    global _start
+    with _lock:
+        _stages.clear()
+    if _enabled:
+        _start = time.perf_counter()
+    else:
+        _start = None
+    return
+
+
+def stage(name, nbytes=0, items=1):
+    """Time a block of code as one call of a stage.
+
+    Use it as "with stage(name) as t:", and add the bytes or items handled
+    with t.add() if they are not known up front.  While instrumentation is
+    disabled this returns a shared no-op object, so the cost is one
+    function call.
+    """
+    if not _enabled:
+        return _null
+    return _Timer(name, nbytes, items)
+
+
+def record(name, seconds, nbytes=0, items=1):
+    """Add one call of a stage that was timed elsewhere.
+    """
+    if not _enabled:
+        return
+    with _lock:
+        st = _stages.get(name, None)
+        if st is None:
+            st = StageStats(name)
+            _stages[name] = st
+        st.add(seconds, nbytes, items)
+    return
+
+
+def stages():
+    """Return the StageStats of all stages, sorted by total time.
+    """
+    with _lock:
+        ret = list(_stages.values())
+    ret.sort(key=lambda x: x.seconds, reverse=True)
+    return ret
+
+
+def report():
+    """Return all timings as a dictionary, ready for JSON.
+    """
+    wall = 0.0
+    if _start is not None:
+        wall = time.perf_counter() - _start
+    return {
+        "wall_seconds": wall,
+        "stages": dict([(x.name, x.report()) for x in stages()]),
+    }
+
+
+def summary():
+    """Return a table of the stages, slowest first.
+
+    Stages run in worker threads can overlap each other, so the shares of
+    the wall time can add up to more than 100%.
+    """
+    rep = report()
+    wall = max(rep["wall_seconds"], 1.0e-9)
+    lines = list()
+    lines.append("Profile of {:.2f}s:".format(rep["wall_seconds"]))
+    lines.append("  {:16s} {:>8s} {:>9s} {:>6s} {:>9s} {:>9s} {:>9s} "
+        "{:>9s}".format("stage", "calls", "total(s)", "wall%", "mean(ms)",
+        "p50(ms)", "p99(ms)", "MB/s"))
+    for st in stages():
+        mean = st.seconds / max(st.calls, 1)
+        rate = ""
+        if (st.bytes > 0) and (st.seconds > 0):
+            rate = "{:.1f}".format(st.bytes / 1.0e6 / st.seconds)
+        lines.append("  {:16s} {:8d} {:9.3f} {:6.1f} {:9.3f} {:9.3f} "
+            "{:9.3f} {:>9s}".format(st.name, st.calls, st.seconds,
+            100.0 * st.seconds / wall, 1000.0 * mean,
+            1000.0 * st.percentile(0.5), 1000.0 * st.percentile(0.99),
+            rate))
+    return "\n".join(lines)
+
+
+def write_json(path):
+    with open(path, "w") as f:
+        json.dump(report(), f, indent=2, sort_keys=True)
+        f.write("\n")
+    return
+
+
+def add_profile_option(parser):
+    """Add the --profile option shared by all scripts to an ArgumentParser.
+    """
+    parser.add_argument( "--profile", required=False, default=None,
+        nargs="?", const="", metavar="JSON",
+        help="print the time spent in each stage when done, and also "
+        "write it to this JSON file if given (as --profile=FILE)" )
+    return
+
+
+def profile_start(option):
+    """Enable instrumentation if the --profile option was given.
+
+    The profile is then reported by profile_finish when the script exits.
+    """
+    if option is not None:
+        enable()
+        atexit.register(profile_finish, option)
+    return
+
+
+def profile_finish(option):
+    """Print (and maybe write) the profile if the --profile option was given.
+    """
+    if option is None:
+        return
+    print(summary(), file=sys.stderr)
+    if option != "":
+        write_json(option)
+    return
@@ -0,0 +1,222 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import sqlite3
+
+from .hashing import file_digest
+
+from .db import DB
+
+
+manifest_name = ".photosort_manifest.db"
+
+library_name = "photosync.db"
+
+export_manifest_name = ".photosort_export.db"
+
+
+class Manifest(object):
+    """A cache of the digests of all files in a directory tree.
+
+    The manifest is a small sqlite file at the top of the tree.  A cached
+    digest is only used if the size and mtime of the file still match.
+    """
+
+    def __init__(self, root, path=None):
+        self.root = root
+        if path is None:
+            path = os.path.join(root, manifest_name)
+        self.path = path
+        self.conn = sqlite3.connect(self.path)
+        cur = self.conn.cursor()
+        cur.execute('create table if not exists files (path text primary '
+            'key, size integer, mtime integer, digest text, hashalg text)')
+        self.conn.commit()
+        self._pending = 0
+
+    def lookup(self, relpath, st, hashalg):
+        cur = self.conn.cursor()
+        cur.execute('select size, mtime, digest, hashalg from files where '
+            'path = ?', (relpath,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        if (row[0], row[1], row[3]) != (st.st_size, st.st_mtime_ns, hashalg):
+            return None
+        return row[2]
+
+    def update(self, relpath, st, digest, hashalg):
+        cur = self.conn.cursor()
+        cur.execute('insert or replace into files values (?, ?, ?, ?, ?)',
+            (relpath, st.st_size, st.st_mtime_ns, digest, hashalg))
+        self._pending += 1
+        if self._pending >= 1000:
+            self.commit()
+        return
+
+    def prune(self, seen):
+        """Remove entries of files that are not in the set seen.
+        """
+        cur = self.conn.cursor()
+        cur.execute('select path from files')
+        gone = [(x[0],) for x in cur.fetchall() if x[0] not in seen]
+        cur.executemany('delete from files where path = ?', gone)
+        self.commit()
+        return len(gone)
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
+
+
+class TreeDigests(object):
+    """Look up or compute the digests of the files in one tree.
+
+    Digests come from the photosort DB when the tree is a library and the
+    file is indexed with a matching stat, then from the manifest, and are
+    only computed from the file contents as a last resort.
+    """
+
+    def __init__(self, root, hashalg="md5", manifest=True):
+        self.root = root
+        self.hashalg = hashalg
+        self.library = dict()
+        libpath = os.path.join(root, library_name)
+        if os.path.isfile(libpath):
+            try:
+                db = DB(libpath, mode='r')
+                self.library = db.stat_index()
+                db.close()
+            except sqlite3.Error:
+                # Pre-migration DBs have no locations or stats.
+                self.library = dict()
+        self.manifest = None
+        if manifest:
+            self.manifest = Manifest(root)
+        self.seen = set()
+        self.hashed = 0
+        self.hashed_bytes = 0
+        self.cached = 0
+
+    def cached_digest(self, relpath, st):
+        """Return the known digest of a file, or None.
+        """
+        self.seen.add(relpath)
+        row = self.library.get(relpath, None)
+        # The inode must match too, so that a copy of the DB in a replica
+        # is never trusted for the replica's files.
+        if (row is not None) and (row[5] == self.hashalg) and \
+            (row[1:4] == (st.st_size, st.st_mtime_ns, st.st_ino)):
+            self.cached += 1
+            return row[0]
+        if self.manifest is not None:
+            digest = self.manifest.lookup(relpath, st, self.hashalg)
+            if digest is not None:
+                self.cached += 1
+            return digest
+        return None
+
+    def compute(self, relpath):
+        """Hash a file.  This is safe to call from worker threads.
+        """
+        return file_digest(os.path.join(self.root, relpath),
+            algorithm=self.hashalg, drop_cache=True)
+
+    def computed(self, relpath, st, digest):
+        """Record a digest returned by compute().
+        """
+        self.hashed += 1
+        self.hashed_bytes += st.st_size
+        if self.manifest is not None:
+            self.manifest.update(relpath, st, digest, self.hashalg)
+        return
+
+    def close(self, prune=True):
+        if self.manifest is not None:
+            if prune:
+                self.manifest.prune(self.seen)
+            self.manifest.close()
+        return
+
+
+class ExportManifest(object):
+    """The outputs of previous exports to a directory tree.
+
+    Entries map the (digest, resolution) of an exported file to the path
+    of the output, relative to the top of the tree, and the size and mtime
+    of the output when it was written.  All entries are loaded when the
+    manifest is opened, so lookups are safe from worker threads.  Updates
+    must come from the thread that opened the manifest.
+    """
+
+    def __init__(self, root, path=None):
+        self.root = os.path.abspath(root)
+        if path is None:
+            path = os.path.join(self.root, export_manifest_name)
+        self.path = path
+        self.conn = sqlite3.connect(self.path)
+        cur = self.conn.cursor()
+        cur.execute('create table if not exists exports (digest text, '
+            'resolution text, path text, size integer, mtime integer, '
+            'primary key (digest, resolution))')
+        self.conn.commit()
+        self.entries = dict()
+        cur.execute('select digest, resolution, path, size, mtime from '
+            'exports')
+        for row in cur:
+            self.entries[(row[0], row[1])] = tuple(row[2:])
+        self._pending = 0
+
+    def recorded(self, digest, resolution):
+        """Return the absolute path of the recorded output, or None.
+        """
+        row = self.entries.get((digest, resolution), None)
+        if row is None:
+            return None
+        return os.path.join(self.root, row[0])
+
+    def current(self, digest, resolution):
+        """Return the recorded output if it is unchanged since the export.
+        """
+        row = self.entries.get((digest, resolution), None)
+        if row is None:
+            return None
+        path = os.path.join(self.root, row[0])
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if (st.st_size, st.st_mtime_ns) != row[1:]:
+            return None
+        return path
+
+    def update(self, digest, resolution, path):
+        st = os.stat(path)
+        row = (os.path.relpath(os.path.abspath(path), self.root),
+            st.st_size, st.st_mtime_ns)
+        self.entries[(digest, resolution)] = row
+        cur = self.conn.cursor()
+        cur.execute('insert or replace into exports values (?, ?, ?, ?, ?)',
+            (digest, resolution) + row)
+        self._pending += 1
+        if self._pending >= 1000:
+            self.commit()
+        return
+
+    def commit(self):
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self):
+        if self.conn is not None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
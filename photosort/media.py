@@ -4,6 +4,7 @@ from __future__ import (absolute_import, division, print_function,
 
 import os
 import sys
+import io
 import re
 import subprocess as sp
 import json
@@ -12,7 +13,22 @@ import datetime
 import time
 import shutil
 
-import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .exiftool import exiftool_pool, ExifToolError
+
+from .hashing import (file_digest, fingerprint_hash,
+    fingerprint_blocksize)
+
+from .instrument import stage
+
+from .transfer import place_file, set_file_date
+
+from .resize import (resize_supported, resize_jpeg, resolution_scale,
+    pillow_enabled, raw_dimensions, embedded_preview)
+
+from .similar import image_dhash
 
 
 image_nonraw_ext = [
@@ -38,6 +54,14 @@ video_ext = [
     "m4a", "m4b", "m4p", "m4v"
 ]
 
+image_ext_set = frozenset(image_ext)
+
+video_ext_set = frozenset(video_ext)
+
+# Kind of media of each (lower case) extension.
+media_kinds = dict([(x, "image") for x in image_ext] + \
+    [(x, "video") for x in video_ext])
+
 image_date_meta = [
     "DateTimeOriginal", "DateTime"
 ]
@@ -48,48 +72,134 @@ video_date_meta = [
 
 
 def file_md5(filename, blocksize=2**20):
-    m = hashlib.md5()
-    #print("getting md5 of \"{}\"".format(self.path))
-    with open( filename, "rb" ) as f:
-        while True:
-            buf = f.read(blocksize)
-            if not buf:
-                break
-            m.update( buf )
-    return m.hexdigest()
+    return file_digest(filename, algorithm="md5", blocksize=blocksize)
+
+
+def file_fingerprint(filename, size=None):
+    """A cheap partial checksum of a file.
+
+    This is the md5 of the file size and the first and last blocks.  Files
+    with different fingerprints always differ, but equal fingerprints
+    only make a full checksum comparison worthwhile.  file_digest can
+    compute it in the same read as the full checksum.
+    """
+    if size is None:
+        size = os.path.getsize(filename)
+    blocksize = fingerprint_blocksize
+    tail = b""
+    with stage("fingerprint"), open( filename, "rb" ) as f:
+        head = f.read(blocksize)
+        if size > blocksize:
+            f.seek(max(blocksize, size - blocksize))
+            tail = f.read(blocksize)
+    return fingerprint_hash(size, head, tail)
 
 
 def file_json(filename):
-    exif = None
-    try:
-        exif = sp.check_output ( [ "exiftool", "-j", "-sort", filename ],
-            universal_newlines=True )
-    except:
-        exif = "[{}]"
-    return json.loads(exif.rstrip("\r\n"))[0]
+    return file_json_batch([filename])[0]
+
+
+def file_json_batch(filenames):
+    """Get the exiftool metadata of many files with the persistent pool.
+    """
+    ret = []
+    piped = []
+    for f in filenames:
+        if "\n" in f:
+            # The -@ argument file cannot express this name, so fall back
+            # to a one-off process.
+            exif = None
+            try:
+                exif = sp.check_output ( [ "exiftool", "-j", "-sort", f ],
+                    universal_newlines=True )
+            except:
+                exif = "[{}]"
+            ret.append(json.loads(exif.rstrip("\r\n"))[0])
+        else:
+            ret.append(None)
+            piped.append(f)
+    with stage("exiftool_read", items=len(piped)):
+        metas = exiftool_pool().map(piped)
+    indx = 0
+    for i in range(len(ret)):
+        if ret[i] is None:
+            ret[i] = metas[indx]
+            indx += 1
+    return ret
+
+
+def video_duration(meta):
+    """Return the duration in seconds from exiftool metadata, or None.
+
+    exiftool prints either "12.34 s" or "H:MM:SS".
+    """
+    dur = meta.get("Duration", None)
+    if dur is None:
+        return None
+    if isinstance(dur, (int, float)):
+        return float(dur)
+    mat = re.match(r"^\s*([\d.]+)\s*s", dur)
+    if mat is not None:
+        return float(mat.group(1))
+    mat = re.match(r"^\s*(\d+):(\d+):(\d+(?:\.\d*)?)", dur)
+    if mat is not None:
+        return 3600.0 * int(mat.group(1)) + 60.0 * int(mat.group(2)) + \
+            float(mat.group(3))
+    return None
+
+
+def meta_summary(meta):
+    """Return the (make, model, width, height, duration) of a file.
+
+    These are the metadata values that are kept in their own DB columns.
+    Missing values are None.
+    """
+    dims = raw_dimensions(meta)
+    if dims is None:
+        dims = (None, None)
+    return (meta.get("Make", None), meta.get("Model", None), dims[0],
+        dims[1], video_duration(meta))
 
 
 def file_setdate(filename, date):
-    # datestr = "{:04d}:{:02d}:{:02d} {:02d}:{:02d}:{:02d}".format(int(date[0]),
-    #     int(date[1]), int(date[2]), int(date[3]), int(date[4]), int(date[5]))
-    # st = time.strptime(datestr, "%Y:%m:%d %H:%M:%S")
-    # systime = time.mktime(st)
-    # os.utime(filename, times=(systime, systime))
-    datestr = "{:04d}{:02d}{:02d}{:02d}{:02d}.{:02d}".format(int(date[0]),
-        int(date[1]), int(date[2]), int(date[3]), int(date[4]), int(date[5]))
-    sp.check_call(["touch", "-t", datestr, filename])
+    set_file_date(filename, date)
     return
 
 
 def file_setmetadate(filename, date):
+    failed = file_setmetadate_batch([filename], date)
+    if filename in failed:
+        raise RuntimeError("cannot set date of {}: {}".format(filename,
+            failed[filename]))
+    return
+
+
+def file_setmetadate_batch(filenames, date, jobs=None):
+    """Set the metadata dates of many files with persistent exiftool workers.
+
+    Up to jobs files are processed at once.  If jobs is None, the shared
+    writer pool is used at its current size.  Failures do not stop the
+    batch.  Returns a dictionary with the error message of each file that
+    could not be updated.
+    """
     comstr = "File dates corrected by photosort on {}"\
         .format(datetime.datetime.strftime(datetime.datetime.now(),
         "%Y-%m-%d %H:%M:%S"))
     datestr = "{:04d}:{:02d}:{:02d} {:02d}:{:02d}:{:02d}".format(int(date[0]),
         int(date[1]), int(date[2]), int(date[3]), int(date[4]), int(date[5]))
-    code = sp.check_call ( [ "exiftool", "-AllDates={}".format(datestr),
-        "-overwrite_original", "-comment={}".format(comstr), filename ] )
-    return
+    pool = exiftool_pool(jobs, writer=True)
+
+    def run(filename):
+        return exiftool_write([ "-AllDates={}".format(datestr),
+            "-overwrite_original", "-comment={}".format(comstr),
+            filename ])
+
+    failed = dict()
+    with ThreadPoolExecutor(max_workers=pool.nworker) as tpool:
+        for f, err in zip(filenames, tpool.map(run, filenames)):
+            if err is not None:
+                failed[f] = err
+    return failed
 
 
 def good_date(date):
@@ -147,43 +257,42 @@ def file_rootname(full):
     return filename, ckshort
 
 
+def file_ext(filename):
+    """Split the base name of a file at its last dot.
+
+    Returns (root, ext), or None if the name has no extension.
+    """
+    root, dot, ext = os.path.basename(filename).rpartition(".")
+    if dot == "":
+        return None
+    return root, ext
+
+
+def media_kind(filename):
+    """Return "image", "video" or None, based on the file extension.
+    """
+    split = file_ext(filename)
+    if split is None:
+        return None
+    return media_kinds.get(split[1].lower(), None)
+
+
 def file_format(filename):
-    base = os.path.basename(filename)
-    mat = re.match("(.*)\.(.*)", base)
-    if mat is None:
+    split = file_ext(filename)
+    if split is None:
         raise RuntimeError("file name {} does not have an extension"\
             .format(filename))
-    root = mat.group(1)
-    ext = mat.group(2)
-    return root, ext.lower()
+    return split[0], split[1].lower()
 
 
 def is_image(filename):
-    base = os.path.basename(filename)
-    mat = re.match("(.*)\.(.*)", base)
-    if mat is None:
-        raise RuntimeError("file name {} does not have an extension"\
-            .format(filename))
-    root = mat.group(1)
-    ext = mat.group(2)
-    if ext.lower() in image_ext:
-        return True
-    else:
-        return False
+    root, ext = file_format(filename)
+    return (media_kinds.get(ext, None) == "image")
 
 
 def is_video(filename):
-    base = os.path.basename(filename)
-    mat = re.match("(.*)\.(.*)", base)
-    if mat is None:
-        raise RuntimeError("file name {} does not have an extension"\
-            .format(filename))
-    root = mat.group(1)
-    ext = mat.group(2)
-    if ext.lower() in video_ext:
-        return True
-    else:
-        return False
+    root, ext = file_format(filename)
+    return (media_kinds.get(ext, None) == "video")
 
 
 def file_date(filename, meta, prior, file_time=False):
@@ -194,6 +303,7 @@ def file_date(filename, meta, prior, file_time=False):
     ret["hour"] = None
     ret["minute"] = None
     ret["second"] = None
+    ret["key"] = None
     datepat = re.compile(r"^(\d\d\d\d):(\d\d):(\d\d)\s+(\d\d):(\d\d):(\d\d).*")
     for p in prior:
         if p in meta.keys():
@@ -206,7 +316,7 @@ def file_date(filename, meta, prior, file_time=False):
                 ret["hour"] = mat.group(4)
                 ret["minute"] = mat.group(5)
                 ret["second"] = mat.group(6)
-                #print("file_date:  using key {}".format(p))
+                ret["key"] = p
                 break
     if ret["year"] is None:
         # We have no metadata date information.  Since timestamps
@@ -225,6 +335,7 @@ def file_date(filename, meta, prior, file_time=False):
             datepat = re.compile(r"^(\d*)-(\d*)-(\d*)\s+(\d*):(\d*):(\d*)\s*")
             datemat = datepat.match(tstr)
             if datemat:
+                ret["key"] = "FileModifyDate"
                 ret["year"] = datemat.group(1)
                 ret["month"] = datemat.group(2)
                 ret["day"] = datemat.group(3)
@@ -244,10 +355,27 @@ def is_subdir(path, directory):
         return True
 
 
-def next_available(path):
+def _reserve(path):
+    # Atomically create an empty placeholder, so that concurrent exports
+    # never pick the same name.
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError:
+        return False
+    os.close(fd)
+    return True
+
+
+def next_available(path, reserve=False):
     """Get the next available filename.
+
+    If reserve is True, an empty file is created with the returned name.
     """
-    if not os.path.isfile(path):
+    if reserve:
+        taken = lambda x: not _reserve(x)
+    else:
+        taken = os.path.isfile
+    if not taken(path):
         return path
     dirname = os.path.dirname(path)
     filename = os.path.basename(path)
@@ -262,7 +390,7 @@ def next_available(path):
     next = None
     while found:
         next = os.path.join(dirname, "{}-{:02d}.{}".format(root, cnt, ext))
-        if os.path.isfile(next):
+        if taken(next):
             cnt += 1
             if cnt > 99:
                 raise RuntimeError("too many duplicate names!")
@@ -271,52 +399,250 @@ def next_available(path):
     return next
 
 
-class Image(object):
+def exiftool_write(args):
+    """Run an exiftool command that modifies files.
+
+    Returns None on success, or the error output of exiftool.
+    """
+    try:
+        with stage("exiftool_write"):
+            out = exiftool_pool(writer=True).execute(args)
+    except ExifToolError as e:
+        return str(e)
+    out = out.decode("utf-8", "replace")
+    mat = re.search(r"(\d+) image files updated", out)
+    if (mat is None) or (int(mat.group(1)) == 0):
+        return out.strip()
+    return None
+
+
+def _run_pipeline(coms, path):
+    # Run a list of commands, each piped into the next, and raise if any
+    # of them fails.
+    with stage("external"):
+        procs = list()
+        stdin = None
+        for com in coms:
+            stdout = None
+            if len(procs) < len(coms) - 1:
+                stdout = sp.PIPE
+            try:
+                proc = sp.Popen(com, stdin=stdin, stdout=stdout, stderr=None)
+            except OSError as e:
+                for p in procs:
+                    p.kill()
+                    p.wait()
+                raise RuntimeError("cannot run {}: {}".format(com[0], e))
+            if stdin is not None:
+                # Let the upstream process see SIGPIPE if this one exits.
+                stdin.close()
+            stdin = proc.stdout
+            procs.append(proc)
+        failed = list()
+        for com, proc in zip(coms, procs):
+            if proc.wait() != 0:
+                failed.append("{} exited with code {}".format(com[0],
+                    proc.returncode))
+    if len(failed) > 0:
+        raise RuntimeError("export to {} failed: {}".format(path,
+            ", ".join(failed)))
+    return
+
+
+class Media(object):
+    """Common base class of Image and Video.
 
-    def __init__(self, path, file_time=False):
-        self.type = "image"
+    The metadata, date, checksum, stat and the names derived from them are
+    only computed when first accessed.  Callers that already have the
+    exiftool metadata, the md5 sum or the stat of the file can pass them
+    in, so that the file is not read again.  The checksum is computed with
+    the hashalg algorithm, in the same read as the fingerprint when
+    neither is known yet.
+    """
+
+    type = None
+    desc = None
+    exts = frozenset()
+    date_meta = []
+
+    def __init__(self, path, file_time=False, meta=None, md5=None,
+        st=None, hashalg="md5", fprint=None):
         self.path = path
-        bname = os.path.basename(self.path)
-        mat = re.match("(.*)\.(.*)", bname)
-        if mat is None:
+        split = file_ext(self.path)
+        if split is None:
             raise RuntimeError(\
                 "file {} does not have an extension".format(self.path))
-        self.root = mat.group(1)
-        self.ext = mat.group(2)
+        self.root, self.ext = split
+        if self.ext.lower() not in self.exts:
+            raise RuntimeError("file {} is not {}".format(self.path,
+                self.desc))
+        self.file_time = file_time
+        self.hashalg = hashalg
+        self._meta = meta
+        self._md5 = md5
+        self._stat = st
+        self._fprint = fprint
+        self._date = None
+        self._dhash = None
+        self._dhash_known = False
+
+    @property
+    def meta(self):
+        if self._meta is None:
+            self._meta = file_json(self.path)
+        return self._meta
+
+    @property
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.stat(self.path)
+        return self._stat
+
+    @property
+    def fprint(self):
+        if self._fprint is None:
+            if self._md5 is None:
+                self._hash()
+            else:
+                self._fprint = file_fingerprint(self.path, self.stat.st_size)
+        return self._fprint
+
+    @property
+    def md5(self):
+        # For historical reasons this is called md5, but it is the digest
+        # computed with hashalg.
+        if self._md5 is None:
+            if self._fprint is None:
+                self._hash()
+            else:
+                self._md5 = file_digest(self.path, algorithm=self.hashalg)
+        return self._md5
 
-        if (self.ext.lower() in image_raw_ext) or (self.ext.lower() \
-            in image_nonraw_ext):
-            self.meta = file_json(self.path)
-        else:
-            raise RuntimeError("file {} is not an image".format(self.path))
-
-        metadate = file_date(self.path, self.meta, image_date_meta,
-            file_time=file_time)
-
-        self.year = metadate["year"]
-        self.month = metadate["month"]
-        self.day = metadate["day"]
-        self.hour = metadate["hour"]
-        self.minute = metadate["minute"]
-        self.second = metadate["second"]
-
-        self.md5 = file_md5(self.path)
-        rname, ckshort = file_rootname(bname)
-        self.name = file_ckname(rname, self.md5)
-        self.uid = "{}{}{}:{}{}{}:{}".format(self.year, self.month, self.day,
+    def _hash(self):
+        self._md5, self._fprint = file_digest(self.path,
+            algorithm=self.hashalg, fingerprint=True)
+        return
+
+    def _compute_dhash(self):
+        return None
+
+    @property
+    def dhash(self):
+        """The perceptual difference hash (see similar.dhash), or None.
+
+        It can be assigned if it was computed elsewhere.
+        """
+        if not self._dhash_known:
+            self._dhash = self._compute_dhash()
+            self._dhash_known = True
+        return self._dhash
+
+    @dhash.setter
+    def dhash(self, value):
+        self._dhash = value
+        self._dhash_known = True
+
+    def _metadate(self):
+        if self._date is None:
+            self._date = file_date(self.path, self.meta, self.date_meta,
+                file_time=self.file_time)
+        return self._date
+
+    @property
+    def year(self):
+        return self._metadate()["year"]
+
+    @property
+    def month(self):
+        return self._metadate()["month"]
+
+    @property
+    def day(self):
+        return self._metadate()["day"]
+
+    @property
+    def hour(self):
+        return self._metadate()["hour"]
+
+    @property
+    def minute(self):
+        return self._metadate()["minute"]
+
+    @property
+    def second(self):
+        return self._metadate()["second"]
+
+    @property
+    def datekey(self):
+        """The metadata key the date was taken from, or None.
+        """
+        return self._metadate()["key"]
+
+    @property
+    def name(self):
+        rname, ckshort = file_rootname(os.path.basename(self.path))
+        return file_ckname(rname, self.md5)
+
+    @property
+    def uid(self):
+        return "{}{}{}:{}{}{}:{}".format(self.year, self.month, self.day,
             self.hour, self.minute, self.second, self.name)
-        #print("Image ctor {}".format(self.path))
-        #print("  name = {}".format(self.name))
-        #print("  root = {}, ext = {}".format(self.root, self.ext))
-        #print("  md5 = {}".format(self.md5))
-        #print("  {}-{}-{} {}:{}:{}".format(self.year, self.month, self.day,
-        #    self.hour, self.minute, self.second))
-        #print("  UID = {}".format(self.uid))
-        #print("  exif:")
-        #for k, v in self.meta.items():
-        #    print ("    {} = {}".format(k, v))
-
-    def export(self, dir, resolution="FULL"):
+
+
+class Image(Media):
+
+    type = "image"
+    desc = "an image"
+    exts = image_ext_set
+    date_meta = image_date_meta
+
+    def _compute_dhash(self):
+        return image_dhash(self.path, self.meta)
+
+    def _export_preview(self, path, scale, backend):
+        # Write a scaled copy of the largest embedded JPEG preview of a RAW
+        # file, if it is large enough.  Returns False if not.
+        full = raw_dimensions(self.meta)
+        if full is None:
+            return False
+        target = (max(1, int(round(full[0] * scale))),
+            max(1, int(round(full[1] * scale))))
+        preview = embedded_preview(self.path, self.meta, target)
+        if preview is None:
+            return False
+        data, dims = preview
+        # Keep the aspect ratio and orientation of the preview.
+        factor = max(target) / max(dims)
+        size = (max(1, int(round(dims[0] * factor))),
+            max(1, int(round(dims[1] * factor))))
+        if pillow_enabled(backend):
+            if resize_jpeg(io.BytesIO(data), path, size=size, quality=95):
+                return True
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+            suffix=".jpg", prefix=".preview.")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            _run_pipeline([["convert", "-scale",
+                "{}x{}!".format(size[0], size[1]), "-quality", "95",
+                tmp, path]], path)
+        finally:
+            os.remove(tmp)
+        return True
+
+    def export(self, dir, resolution="FULL", link="reflink",
+        backend="auto", preview=True):
+        """Export the image to a directory and return the output path.
+
+        Full-size RAW and JPEG files are placed in the directory according
+        to the link mode (see place_file).  Reduced JPEGs are scaled
+        in-process when the resize backend allows it (see resize_supported),
+        and with ImageMagick otherwise.  Reduced RAW files are made from
+        their largest embedded preview if it is large enough and preview is
+        True, and are demosaiced with dcraw otherwise.  RuntimeError is
+        raised if any of the external tools fails, in which case no partial
+        output is left behind.
+        """
         qual_opts = ["-quality", "95"]
         res_opts = []
         if resolution == "MED":
@@ -328,112 +654,83 @@ class Image(object):
 
         rname, ckshort = file_rootname(self.name)
 
-        if self.ext.lower() in image_raw_ext:
-            # We have a raw file.
-            if (resolution == "FULL"):
-                # just copy to output
-                path = os.path.join(dir, rname)
-                path = next_available(path)
-                shutil.copy2(self.path, path)
-            else:
-                # Extract with dcraw and pipe to convert.  Resize before JPEG
-                # conversion. Then copy metadata with exiftool.
-                path = os.path.join(dir,
-                    "{}.jpg".format(os.path.splitext(rname)[0]))
-                path = next_available(path)
-                com_convert = ["convert"]
-                com_convert.extend(res_opts)
-                com_convert.extend(qual_opts)
+        if (resolution == "FULL") and ((self.ext.lower() in image_raw_ext) \
+            or (self.ext.lower() == "jpg")):
+            # just copy to output
+            path = os.path.join(dir, rname)
+            path = next_available(path, reserve=True)
+            try:
+                place_file(self.path, path, mode=link)
+            except:
+                os.remove(path)
+                raise
+            return path
+
+        path = os.path.join(dir,
+            "{}.jpg".format(os.path.splitext(rname)[0]))
+        path = next_available(path, reserve=True)
+        com_convert = ["convert"]
+        com_convert.extend(res_opts)
+        com_convert.extend(qual_opts)
+        try:
+            if (resolution in resolution_scale) and \
+                resize_supported(self.path, backend=backend):
+                # The EXIF block is carried over, so there is no need for
+                # exiftool.
+                if resize_jpeg(self.path, path,
+                    resolution_scale[resolution], quality=95):
+                    return path
+            if preview and (self.ext.lower() in image_raw_ext) and \
+                (resolution in resolution_scale) and \
+                self._export_preview(path, resolution_scale[resolution],
+                backend):
+                # Scaled from the embedded preview.
+                pass
+            elif self.ext.lower() in image_raw_ext:
+                # Extract with dcraw and pipe to convert.  Resize before
+                # JPEG conversion.
                 com_convert.append("pnm:-")
                 com_convert.append(path)
-                com_meta = ["exiftool", "-q", "-overwrite_original",
-                    "-TagsFromFile", self.path, path]
-                proc_dcraw = sp.Popen([ "dcraw", "-c", self.path ],
-                    stdout=sp.PIPE, stderr=None, stdin=None)
-                proc_convert = sp.Popen(com_convert, stdin=proc_dcraw.stdout,
-                    stdout=None, stderr=None)
-                output = proc_convert.communicate()[0]
-                proc_convert.wait()
-                proc_meta = sp.Popen(com_meta, stdout=None, stderr=None, stdin=None)
-                proc_meta.wait()
-        else:
-            if (resolution == "FULL") and (self.ext.lower() == "jpg"):
-                # copy to output
-                path = os.path.join(dir, rname)
-                path = next_available(path)
-                shutil.copy2(self.path, path)
+                _run_pipeline([[ "dcraw", "-c", self.path ], com_convert],
+                    path)
             else:
-                # Just use convert directly, then copy
-                # metadata with exiftool.
-                path = os.path.join(dir,
-                    "{}.jpg".format(os.path.splitext(rname)))
-                path = next_available(path)
-                com = ["convert"]
-                com.extend(res_opts)
-                com.extend(qual_opts)
-                com.append(self.path)
-                com.append(path)
-                proc_export = sp.Popen(com, stdout=None, stderr=None,
-                    stdin=None)
-                proc_export.wait()
-                proc_meta = sp.Popen(com_meta, stdout=None, stderr=None,
-                    stdin=None)
-                proc_meta.wait()
-        return
+                # Just use convert directly.
+                com_convert.append(self.path)
+                com_convert.append(path)
+                _run_pipeline([com_convert], path)
+            # Then copy metadata with exiftool.
+            err = exiftool_write(["-overwrite_original", "-TagsFromFile",
+                self.path, path])
+            if err is not None:
+                raise RuntimeError("cannot copy metadata to {}: {}"\
+                    .format(path, err))
+        except:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return path
 
 
-class Video(object):
+class Video(Media):
 
-    def __init__(self, path, file_time=False):
-        self.type = "video"
-        self.path = path
-        bname = os.path.basename(self.path)
-        mat = re.match("(.*)\.(.*)", bname)
-        if mat is None:
-            raise RuntimeError(\
-                "file {} does not have an extension".format(self.path))
-        self.root = mat.group(1)
-        self.ext = mat.group(2)
+    type = "video"
+    desc = "a video"
+    exts = video_ext_set
+    date_meta = video_date_meta
 
-        if self.ext.lower() in video_ext:
-            self.meta = file_json(self.path)
-        else:
-            raise RuntimeError("file {} is not a video".format(self.path))
-
-        metadate = file_date(self.path, self.meta, video_date_meta,
-            file_time=file_time)
-
-        self.year = metadate["year"]
-        self.month = metadate["month"]
-        self.day = metadate["day"]
-        self.hour = metadate["hour"]
-        self.minute = metadate["minute"]
-        self.second = metadate["second"]
-
-        self.md5 = file_md5(self.path)
-        rname, ckshort = file_rootname(bname)
-        self.name = file_ckname(rname, self.md5)
-        self.uid = "{}{}{}:{}{}{}:{}".format(self.year, self.month, self.day,
-            self.hour, self.minute, self.second, self.name)
-        #print("Video ctor {}".format(self.path))
-        #print("  name = {}".format(self.name))
-        #print("  root = {}, ext = {}".format(self.root, self.ext))
-        #print("  md5 = {}".format(self.md5))
-        #print("  {}-{}-{} {}:{}:{}".format(self.year, self.month, self.day,
-        #    self.hour, self.minute, self.second))
-        #print("  UID = {}".format(self.uid))
-        #print("  exif:")
-        #for k, v in self.meta.items():
-        #    print ("    {} = {}".format(k, v))
-
-    def export(self, dir, resolution="FULL"):
+    def export(self, dir, resolution="FULL", link="reflink",
+        backend="auto", preview=True):
         if resolution != "FULL":
             raise NotImplementedError("Video reduction not yet supported")
         rname, ckshort = file_rootname(self.name)
         path = os.path.join(dir, rname)
-        path = next_available(path)
-        shutil.copy2(self.path, path)
-        return
+        path = next_available(path, reserve=True)
+        try:
+            place_file(self.path, path, mode=link)
+        except:
+            os.remove(path)
+            raise
+        return path
 
 
 
@@ -3,6 +3,7 @@ from __future__ import (absolute_import, division, print_function,
     unicode_literals)
 
 import os
+import sys
 import re
 import shutil
 
@@ -10,143 +11,529 @@ import subprocess as sp
 
 from .media import (Image, Video, image_raw_ext, image_nonraw_ext,
     image_ext, video_ext, file_md5, file_setdate, file_json,
-    is_image, is_video, file_date, good_date, file_rootname,
-    file_ckname, is_subdir, file_setmetadate, file_format)
+    file_json_batch, file_fingerprint, is_image, is_video, file_date,
+    good_date, file_rootname, file_ckname, is_subdir, file_setmetadate,
+    file_format, media_kind)
 
+from .scan import scan_tree
 
-def album_append(adir, album, files):
+from .hashing import file_digest, file_drop_cache
+
+from .transfer import copy_file
+
+from .instrument import stage
+
+from .db import media_columns
+
+
+def read_file_list(path):
+    """Read file names, one per line, from a file or "-" for stdin.
+    """
+    if path == "-":
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, "r") as f:
+            lines = f.read().splitlines()
+    return [x for x in lines if x != ""]
+
+
+def album_name(indir):
+    """Name of the album of the media imported from a directory.
+    """
+    safename = re.compile(r"[^0-9a-zA-Z-\.\/]")
+    return safename.sub("_", os.path.basename(indir))
+
+
+def album_links(albumdir):
+    """Return the targets of the symbolic links in an album directory, by
+    link name, from a single scandir pass.
+    """
+    ret = dict()
+    if not os.path.isdir(albumdir):
+        return ret
+    with os.scandir(albumdir) as it:
+        for entry in it:
+            if entry.is_symlink():
+                ret[entry.name] = os.readlink(entry.path)
+    return ret
+
+
+def materialize_album(db, adir, album, prune=False):
+    """Make the links of an album directory match its members in the DB.
+
+    The directory is read once, and only missing or wrong links are made.
+    Links are relative and named after their file; of several members
+    with the same file name, the first by path is linked.  With prune,
+    links which do not belong to a member are removed.  Other entries of
+    the directory are never touched.  Returns the number of links made and
+    the number removed.
+    """
     albumdir = os.path.join(os.path.abspath(adir), album)
-    #print("albumdir = {}".format(albumdir))
     if not os.path.isdir(albumdir):
-        os.mkdir(albumdir)
+        os.makedirs(albumdir)
+    # All targets start with the path from the album to the media tree.
+    top = os.path.relpath(db.root, albumdir)
+    want = dict()
+    for path in db.album_paths(album):
+        name = os.path.basename(path)
+        if name not in want:
+            want[name] = os.path.join(top, path)
+    made = 0
+    removed = 0
+    with stage("album", items=0) as t:
+        have = album_links(albumdir)
+        for name, target in have.items():
+            if name in want:
+                if os.path.normpath(os.path.join(albumdir, target)) == \
+                    os.path.normpath(os.path.join(albumdir, want[name])):
+                    # Already right, even if spelled differently.
+                    del want[name]
+                    continue
+            elif not prune:
+                continue
+            os.remove(os.path.join(albumdir, name))
+            removed += 1
+        for name, target in want.items():
+            os.symlink(target, os.path.join(albumdir, name))
+            made += 1
+        t.add(items=(made + removed))
+    return made, removed
+
+
+def album_append(adir, album, files, db=None):
+    """Add files to an album.
+
+    With a DB, the files (which must be in its media tree) are recorded as
+    members of the album, and the links are made by materialize_album.
+    Without one, only the missing links are made.
+    """
+    if db is not None:
+        uid_col = media_columns.index("uid")
+        uids = list()
+        for f in files:
+            row = db.query_path(f)
+            if row is None:
+                print("{} is not in the DB, skipping".format(f))
+                continue
+            uids.append(row[uid_col])
+        db.album_add(album, uids)
+        db.commit()
+        materialize_album(db, adir, album)
+        return
+    albumdir = os.path.join(os.path.abspath(adir), album)
+    if not os.path.isdir(albumdir):
+        os.makedirs(albumdir)
+    have = album_links(albumdir)
+    # we want the path relative to the album, which is the same for all
+    # files of one directory
+    reldirs = dict()
     for f in files:
         absfile = os.path.abspath(f)
         filename = os.path.basename(absfile)
-        #print("absfile = {}".format(absfile))
-        #print("filename = {}".format(filename))
-        # we want the path relative to root...
-        relfile = os.path.relpath(absfile, albumdir)
-        #print("relfile = {}".format(relfile))
-        linkpath = os.path.join(albumdir, filename)
-        #print("linkpath = {}".format(linkpath))
-        if not os.path.islink(linkpath):
-            os.symlink(relfile, linkpath)
+        if filename in have:
+            continue
+        srcdir = os.path.dirname(absfile)
+        if srcdir not in reldirs:
+            reldirs[srcdir] = os.path.relpath(srcdir, albumdir)
+        relfile = os.path.join(reldirs[srcdir], filename)
+        os.symlink(relfile, os.path.join(albumdir, filename))
+        have[filename] = relfile
     return
 
 
 def index_media(db, dir, files, file_time=False):
-    for f in files:
-        infile = os.path.abspath( os.path.join(dir, f) )
-        if is_image(infile):
+    infiles = [os.path.abspath( os.path.join(dir, f) ) for f in files]
+    kinds = dict([(x, media_kind(x)) for x in infiles])
+    # Fetch the metadata of the whole directory in batches.
+    media = [x for x in infiles if kinds[x] is not None]
+    metas = dict(zip(media, file_json_batch(media)))
+    objs = list()
+    for infile in infiles:
+        if kinds[infile] == "image":
             print("indexing image {}".format(infile))
-            img = Image(infile, file_time)
-            db.insert(img)
-        elif is_video(infile):
+            objs.append(Image(infile, file_time, meta=metas[infile],
+                hashalg=db.hashalg))
+        elif kinds[infile] == "video":
             print("indexing video {}".format(infile))
-            vid = Video(infile, file_time)
-            db.insert(vid)
+            objs.append(Video(infile, file_time, meta=metas[infile],
+                hashalg=db.hashalg))
         else:
             print("skipping non-media file {}".format(infile))
+    db.insert_many(objs)
+    return
+
+
+def _cache_meta(db, files, file_time):
+    # Fetch and cache the metadata of files that are already indexed.
+    metas = file_json_batch([x[0] for x in files])
+    objs = list()
+    for (infile, chk, st, kind, hashalg), meta in zip(files, metas):
+        cls = Image
+        if kind == "video":
+            cls = Video
+        objs.append(cls(infile, file_time, meta=meta, md5=chk, st=st,
+            hashalg=hashalg))
+    db.store_meta(objs)
+    return
+
+
+def _index_new(db, newfiles, file_time, hashalg):
+    metas = file_json_batch([x[0] for x in newfiles])
+    objs = list()
+    for (infile, chk, st, kind, fprint), meta in zip(newfiles, metas):
+        if kind == "image":
+            print("indexing image {}".format(infile))
+            objs.append(Image(infile, file_time, meta=meta, md5=chk,
+                st=st, hashalg=hashalg, fprint=fprint))
+        else:
+            print("indexing video {}".format(infile))
+            objs.append(Video(infile, file_time, meta=meta, md5=chk,
+                st=st, hashalg=hashalg, fprint=fprint))
+    db.insert_many(objs)
+    return
+
+
+def reconcile_media(db, photodir, file_time=False, rehash=False,
+    exclude=None, batch=256):
+    """Bring the DB in line with the media tree in a single walk.
+
+    Files whose size, mtime and inode match the DB are left alone.  New
+    files are hashed and added, files with a changed stat signature are
+    re-hashed, and rows of files that have vanished are removed.  Rows
+    from a DB without recorded paths are matched up by checksum.  If
+    rehash is True, every file is re-hashed.  Files matching the exclude
+    patterns (see ExcludeRules) are not looked at, and their rows are
+    removed.  New files are indexed in groups of batch files, and the
+    metadata of indexed files which is not cached in the DB yet is
+    fetched in groups of the same size.
+    """
+    hashalg = db.hashalg
+    known = db.stat_index()
+    uncached = db.uncached()
+    seen = set()
+    newfiles = list()
+    newsums = dict()
+    nometa = list()
+
+    def cache_meta(infile, chk, st, kind, alg):
+        # Queue an indexed file whose metadata is not cached yet.
+        if chk in uncached:
+            nometa.append((infile, chk, st, kind, alg))
+            if len(nometa) >= batch:
+                _cache_meta(db, nometa, file_time)
+                del nometa[:]
+
+    for rec in scan_tree(photodir, exclude=exclude,
+        kinds=("image", "video")):
+        infile = rec.path
+        rel = db.relpath(infile)
+        seen.add(rel)
+        st = rec.stat
+        old = known.get(rel, None)
+        if (old is not None) and (not rehash) and \
+            (old[1:4] == (st.st_size, st.st_mtime_ns, st.st_ino)):
+            if old[4] is None:
+                db.update_stat(old[0], infile, st,
+                    fprint=file_fingerprint(infile, st.st_size))
+            cache_meta(infile, old[0], st, rec.kind, old[5])
+            continue
+
+        if old is not None:
+            # Check existing rows with the algorithm they were made with.
+            chk, fprint = file_digest(infile, algorithm=old[5],
+                drop_cache=True, fingerprint=True)
+            if chk == old[0]:
+                db.update_stat(chk, infile, st, fprint=fprint)
+                cache_meta(infile, chk, st, rec.kind, old[5])
+            else:
+                # Leave the row alone, so that this is reported
+                # again until someone looks at it.
+                print("{} has changed since it was indexed and may "
+                    "be corrupted".format(infile))
+            continue
+
+        chk, fprint = file_digest(infile, algorithm=hashalg,
+            fingerprint=True)
+        row = db.query_md5_row(chk)
+        if row is not None:
+            prev = row[media_columns.index("path")]
+            if (prev is None) or (not os.path.exists(
+                os.path.join(db.root, prev))):
+                print("updating location of {}".format(infile))
+                db.update_stat(chk, infile, st, fprint=fprint)
+                cache_meta(infile, chk, st, rec.kind, hashalg)
+            else:
+                print("{} is a duplicate of {}, skipping".format(infile,
+                    os.path.join(db.root, prev)))
+            continue
+        if chk in newsums:
+            print("{} is a duplicate of {}, skipping".format(infile,
+                newsums[chk]))
+            continue
+        newsums[chk] = infile
+        newfiles.append((infile, chk, st, rec.kind, fprint))
+        if len(newfiles) >= batch:
+            _index_new(db, newfiles, file_time, hashalg)
+            newfiles = list()
+    _index_new(db, newfiles, file_time, hashalg)
+    _cache_meta(db, nometa, file_time)
+
+    # Files that were found elsewhere have a new path by now.
+    vanished = [x for x in db.stat_index().keys() if x not in seen]
+    for rel in vanished:
+        print("removing vanished file {}".format(os.path.join(db.root, rel)))
+    db.delete_paths(vanished)
+    db.delete_unlocated()
+    db.prune_meta()
+    db.commit()
+    return
+
+
+def import_destination(obj, outroot):
+    """Return the path in the media tree that obj is imported to.
+    """
+    date = (obj.year, obj.month, obj.day, obj.hour,
+        obj.minute, obj.second)
+    if good_date(date):
+        daydir = os.path.join(outroot, obj.year, obj.month, obj.day)
+    else:
+        # default is to put the file in the broken dir
+        daydir = os.path.join(outroot, "broken")
+    return os.path.abspath( os.path.join(daydir, obj.name) )
+
+
+def plan_imports(db, objs, outroot):
+    """Record a group of imports as planned in the import journal.
+
+    The whole group is committed at once, so that the copies only cost one
+    journal transaction per group instead of one per file.  Call this
+    before import_object(..., planned=True) for each of the objects.
+    """
+    db.journal_plan([(obj.path, obj.stat, obj.md5,
+        import_destination(obj, outroot), obj.file_time) for obj in objs])
     return
 
 
+def import_object(db, obj, indir, outroot, albumdir, planned=False):
+    """Copy one new media object into the tree and add it to the DB.
+
+    The caller must already have checked that the checksum of obj is not
+    in the DB.  The steps are recorded in the import journal, so that
+    repair_journal can finish them after a crash.  If planned is True, the
+    caller already recorded the import with plan_imports.  If albumdir is
+    given, the object is recorded as a member of the album named after
+    indir.  Returns the path of the file in the output tree.
+    """
+    infile = obj.path
+
+    # get the date as a tuple
+    date = (obj.year, obj.month, obj.day, obj.hour,
+        obj.minute, obj.second)
+
+    # does this object have a reasonable date stamp?
+    dategood = good_date(date)
+
+    if dategood:
+        # if the date is reasonable, make the day directory
+        yeardir = os.path.join(outroot, obj.year)
+        monthdir = os.path.join(yeardir, obj.month)
+        daydir = os.path.join(monthdir, obj.day)
+        if not os.path.isdir(outroot):
+            os.mkdir(outroot)
+        if not os.path.isdir(yeardir):
+            os.mkdir(yeardir)
+        if not os.path.isdir(monthdir):
+            os.mkdir(monthdir)
+        if not os.path.isdir(daydir):
+            os.mkdir(daydir)
+
+    # Does an object with this checksum and filename exist
+    # in DB (it shouldn't yet)?
+    result = db.query(obj.uid)
+    if result is not None:
+        raise RuntimeError("file with same name, date and "
+            "checksum prefix found which is not in DB.  You "
+            "should rebuild the index.")
+
+    # Near-duplicates (resized or re-encoded copies) are imported anyway,
+    # but reported.
+    if (db.similar_distance is not None) and (obj.type == "image"):
+        for dist, chk in db.query_similar(obj.dhash)[0:3]:
+            row = db.query_md5_row(chk)
+            if row is not None:
+                print("  similar to {} (distance {})".format(
+                    os.path.join(db.root, row[media_columns.index("path")]),
+                    dist))
+
+    outfile = import_destination(obj, outroot)
+    if not planned:
+        db.journal_record(infile, obj.stat, obj.md5, outfile, "planned",
+            file_time=obj.file_time)
+    if infile != outfile:
+        print("  copying to {}".format(outfile))
+        # if the date stamp on the file is good, update
+        # modification time to reflect that.
+        copy_file(infile, outfile, date=(date if dategood else None))
+        db.journal_state(infile, "copied")
+    print("  adding to DB")
+    db.insert(obj, path=outfile)
+    if albumdir is not None:
+        # if we are making albums, the input directory names the album.
+        # The links are made by materialize_album.
+        db.album_add(album_name(indir), [obj.uid])
+    db.journal_state(infile, "committed")
+    return outfile
+
+
+def repair_journal(db):
+    """Finish or undo the imports that were interrupted by a crash.
+
+    For every journal entry that was not committed, a complete copy in the
+    media tree is added to the DB, and otherwise the entry is forgotten so
+    that the input is imported again.  Temporary files of interrupted
+    copies are removed.  Album links of repaired files are not made.
+    Returns the number of repaired files.
+    """
+    repaired = 0
+    for infile, chk, outfile, state, file_time in db.journal_pending():
+        if db.query_md5(chk):
+            db.journal_state(infile, "committed")
+            continue
+        outdir = os.path.dirname(outfile)
+        prefix = ".{}.".format(os.path.basename(outfile))
+        if os.path.isdir(outdir):
+            for name in os.listdir(outdir):
+                if name.startswith(prefix) and name.endswith(".part"):
+                    os.remove(os.path.join(outdir, name))
+        kind = media_kind(outfile)
+        if (kind is not None) and os.path.isfile(outfile) and \
+            (file_digest(outfile, algorithm=db.hashalg) == chk):
+            print("repairing interrupted import of {} to {}".format(infile,
+                outfile))
+            # The date of the copy is found the same way as that of the
+            # input was.
+            if kind == "image":
+                obj = Image(outfile, file_time, md5=chk, hashalg=db.hashalg)
+            else:
+                obj = Video(outfile, file_time, md5=chk, hashalg=db.hashalg)
+            db.insert(obj)
+            db.journal_state(infile, "committed")
+            repaired += 1
+        else:
+            print("restarting interrupted import of {}".format(infile))
+            db.journal_forget(infile)
+    db.commit()
+    return repaired
+
+
 def import_media(db, indir, files, outroot, albumdir,
-    file_time=False):
+    file_time=False, journal=True):
+    """Import the media files of one directory.
+
+    Unless journal is False, inputs which the import journal shows were
+    already imported, and which have not changed since, are skipped
+    without hashing them.  Call repair_journal first to finish imports
+    that were interrupted.
+    """
+    # Duplicate checks are answered in memory (loaded once per DB).
+    db.preload_digests()
+    pending = []
     for f in files:
-        mat = re.match("(.*)\.(.*)", f)
-        if mat is None:
-            print("skipping non-media file {}".format(infile))
-            continue
-        ext = mat.group(2)
         infile = os.path.abspath( os.path.join(indir, f) )
-        if (ext.lower() not in image_ext) and \
-            (ext.lower() not in video_ext):
+        if media_kind(f) is None:
             print("skipping non-media file {}".format(infile))
             continue
 
-        # compute MD5 sum
-        chk = file_md5(infile)
+        st = os.stat(infile)
+        if journal and db.journal_done(infile, st):
+            print("{} already imported".format(infile))
+            continue
+
+        # compute the checksum, overlapping reads with hashing.  The page
+        # cache is kept until the file is known to be new, since new files
+        # are copied next.  The fingerprint stored with new files comes
+        # from the same read.
+        chk, fprint = file_digest(infile, algorithm=db.hashalg,
+            readahead=True, fingerprint=True)
 
         # does this checksum already exist in the database?
         print("checking {}".format(infile))
-        if (not db.query_md5(chk)):
+        if db.query_md5(chk):
+            print("  found in DB")
+            file_drop_cache(infile)
+            db.journal_record(infile, st, chk, None, "committed")
+        else:
+            pending.append((infile, chk, st, fprint))
 
-            # load the object depending on type
-            obj = None
-            if is_image(infile):
-                obj = Image(infile, file_time)
-            elif is_video(infile):
-                obj = Video(infile, file_time)
-            else:
-                raise RuntimeError("Should never get here...")
-
-            # get the date as a tuple
-            date = (obj.year, obj.month, obj.day, obj.hour,
-                obj.minute, obj.second)
-
-            # does this object have a reasonable date stamp?
-            dategood = good_date(date)
-
-            # default is to put the file in the broken dir
-            daydir = os.path.join(outroot, "broken")
-
-            if dategood:
-                # if the date is reasonable, make the day directory
-                yeardir = os.path.join(outroot, obj.year)
-                monthdir = os.path.join(yeardir, obj.month)
-                daydir = os.path.join(monthdir, obj.day)
-                if not os.path.isdir(outroot):
-                    os.mkdir(outroot)
-                if not os.path.isdir(yeardir):
-                    os.mkdir(yeardir)
-                if not os.path.isdir(monthdir):
-                    os.mkdir(monthdir)
-                if not os.path.isdir(daydir):
-                    os.mkdir(daydir)
-
-            # Does an object with this checksum and filename exist
-            # in DB (it shouldn't yet)?
-            result = db.query(obj.uid)
-            if result is None:
-                outfile = os.path.abspath( os.path.join(daydir,
-                    obj.name) )
-                if infile != outfile:
-                    print("  copying to {}".format(outfile))
-                    shutil.copy2(infile, outfile)
-                    # if the date stamp on the file is good, update
-                    # modification time to reflect that.
-                    if dategood:
-                        file_setdate(outfile, date)
-                if albumdir is not None:
-                    # if we are making albums, take the parent
-                    # directory and make it the album name
-                    album = os.path.basename(indir)
-                    safename = re.compile(r"[^0-9a-zA-Z-\.\/]")
-                    album = safename.sub("_", album)
-                    album_append(albumdir, album, [outfile])
-                print("  adding to DB")
-                db.insert(obj)
-            else:
-                raise RuntimeError("file with same name, date and "
-                    "checksum prefix found which is not in DB.  You "
-                    "should rebuild the index.")
+    # Fetch the metadata of all new files in batches.
+    metas = file_json_batch([x[0] for x in pending])
+
+    # load the objects depending on type
+    objs = list()
+    for (infile, chk, st, fprint), meta in zip(pending, metas):
+        if is_image(infile):
+            objs.append(Image(infile, file_time, meta=meta, md5=chk, st=st,
+                hashalg=db.hashalg, fprint=fprint))
+        elif is_video(infile):
+            objs.append(Video(infile, file_time, meta=meta, md5=chk, st=st,
+                hashalg=db.hashalg, fprint=fprint))
         else:
+            raise RuntimeError("Should never get here...")
+
+    # Plan the copies of the whole directory in one journal commit.
+    plan_imports(db, objs, outroot)
+
+    imported = 0
+    for obj in objs:
+        # An identical file earlier in this directory may have been
+        # imported in the meantime.
+        if db.query_md5(obj.md5):
             print("  found in DB")
+            db.journal_record(obj.path, obj.stat, obj.md5, None,
+                "committed")
+            continue
+        import_object(db, obj, indir, outroot, albumdir, planned=True)
+        imported += 1
+    db.commit()
+    if (albumdir is not None) and (imported > 0):
+        materialize_album(db, albumdir, album_name(indir))
     return
 
 
-def check_media(db, indir, files, outroot, missing, verbose=False):
+def check_media(db, indir, files, outroot, missing, verbose=False,
+    fast=False):
+    """Check which media files are not in the DB.
+
+    Returns missing plus the size of the media files that were not found.
+    If fast is True, a file is only fully hashed if some file in the DB has
+    the same size and partial fingerprint.  Other files are reported as
+    missing right away, without the check for a name collision.  While
+    some rows of the DB have no size yet (until a reindex), every file is
+    fully hashed.
+    """
+    notfound = []
+    if fast:
+        sizes = db.sizes()
+    db.preload_digests()
     for f in files:
-        mat = re.match("(.*)\.(.*)", f)
-        if mat is None:
-            continue
-        ext = mat.group(2)
-        if (ext.lower() not in image_ext) and \
-            (ext.lower() not in video_ext):
+        if media_kind(f) is None:
             continue
         infile = os.path.abspath( os.path.join(indir, f) )
 
-        chk = file_md5(infile)
+        # Rows without a size (indexed before sizes were recorded) could
+        # be any file, so then every file is fully hashed.
+        if fast and (None not in sizes):
+            size = os.stat(infile).st_size
+            if (size not in sizes) or \
+                (not db.query_fprint(size, file_fingerprint(infile, size))):
+                print("{} not in DB".format(infile))
+                missing += size
+                continue
+
+        # These files are only read to be hashed, so keep them out of the
+        # page cache.
+        chk = file_digest(infile, algorithm=db.hashalg, readahead=True,
+            drop_cache=True)
         rname, chkshort = file_rootname(infile)
 
         if (chkshort != "") and (chkshort != chk[0:4]):
@@ -154,47 +541,64 @@ def check_media(db, indir, files, outroot, missing, verbose=False):
                 "be corrupted".format(infile, chk[0:4], chkshort))
 
         if (not db.query_md5(chk)):
-            obj = None
-            if is_image(infile):
-                obj = Image(infile)
-            elif is_video(infile):
-                obj = Video(infile)
-            else:
-                raise RuntimeError("Should never get here...")
-            print("{} not in DB".format(infile))
-            missing += os.stat(infile).st_size
-
-            yeardir = os.path.join(outroot, obj.year)
-            monthdir = os.path.join(yeardir, obj.month)
-            daydir = os.path.join(monthdir, obj.day)
-
-            result = db.query(obj.uid)
-
-            if result is not None:
-                raise RuntimeError("file with same name, date and "
-                    "checksum prefix found which is not in DB.  You "
-                    "should rebuild the index.")
+            notfound.append((infile, chk))
         else:
             if verbose:
                 print("found {}".format(infile))
+
+    # Fetch the metadata of all missing files in batches.
+    metas = file_json_batch([x[0] for x in notfound])
+
+    for (infile, chk), meta in zip(notfound, metas):
+        obj = None
+        if is_image(infile):
+            obj = Image(infile, meta=meta, md5=chk, hashalg=db.hashalg)
+        elif is_video(infile):
+            obj = Video(infile, meta=meta, md5=chk, hashalg=db.hashalg)
+        else:
+            raise RuntimeError("Should never get here...")
+        print("{} not in DB".format(infile))
+        missing += os.stat(infile).st_size
+
+        yeardir = os.path.join(outroot, obj.year)
+        monthdir = os.path.join(yeardir, obj.month)
+        daydir = os.path.join(monthdir, obj.day)
+
+        result = db.query(obj.uid)
+
+        if result is not None:
+            raise RuntimeError("file with same name, date and "
+                "checksum prefix found which is not in DB.  You "
+                "should rebuild the index.")
     return missing
 
 
-def convert_video(infile, outfile, force=False, skip_apple=True):
+def convert_video(infile, outfile, force=False, skip_apple=True,
+    threads=None, quiet=False, meta=None):
+    """Convert an old video to H.264 in an m4v container.
+
+    The video is encoded to a hidden temporary file next to outfile, which
+    is only renamed to outfile once the encode and the date updates have
+    succeeded, so an interrupted conversion never leaves a partial
+    outfile.  threads limits the number of ffmpeg encoder threads, and
+    quiet only lets ffmpeg print errors.  Returns True if the video was
+    converted and False if it was skipped.  RuntimeError is raised if the
+    conversion fails.
+    """
     if not is_video(infile):
         raise RuntimeError("cannot convert non-video file {}".format(infile))
 
     if os.path.isfile(outfile) and not force:
         print("Skipping existing file {}".format(outfile), flush=True)
-        return
+        return False
 
-    invid = Video(infile)
+    invid = Video(infile, meta=meta)
     # See if we should skip apple videos
     if skip_apple:
         if "Make" in invid.meta:
             if invid.meta["Make"] == "Apple":
                 print("Skipping Apple video {}".format(infile), flush=True)
-                return
+                return False
 
     # get the date as a tuple
     date = (invid.year, invid.month, invid.day, invid.hour,
@@ -205,29 +609,46 @@ def convert_video(infile, outfile, force=False, skip_apple=True):
     if (informat == "avi") or (informat == "mov"):
         if outformat == "m4v":
             # We know what to do...
-            com = ["ffmpeg", "-y", "-i", infile, "-c:v", "libx264", "-pix_fmt",
+            tmp = os.path.join(os.path.dirname(outfile),
+                ".{}.part.{}".format(outbase, outformat))
+            com = ["ffmpeg", "-nostdin", "-y"]
+            if quiet:
+                com.extend(["-loglevel", "error"])
+            com.extend(["-i", infile, "-c:v", "libx264", "-pix_fmt",
                 "yuv420p", "-preset:v", "slow", "-profile:v", "baseline",
-                "-crf", "23", outfile]
+                "-crf", "23"])
+            if threads is not None:
+                com.extend(["-threads", "{:d}".format(int(threads))])
+            com.append(tmp)
             try:
-                code = sp.check_call(com)
-                file_setmetadate(outfile, date)
-                file_setdate(outfile, date)
-                print("Finished converting {}".format(infile), flush=True)
+                try:
+                    with stage("ffmpeg", nbytes=os.path.getsize(infile)):
+                        sp.check_call(com)
+                except sp.CalledProcessError as e:
+                    raise RuntimeError("ffmpeg exited with code {}"\
+                        .format(e.returncode))
+                except OSError as e:
+                    raise RuntimeError("cannot run ffmpeg: {}".format(e))
+                file_setmetadate(tmp, date)
+                file_setdate(tmp, date)
+                os.replace(tmp, outfile)
             except:
-                print("Conversion failed for {}".format(infile), flush=True)
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
         else:
             raise NotImplementedError("Cannot convert '{}' videos to '{}'"\
                 .format(informat, outformat))
     else:
         raise NotImplementedError("Cannot convert '{}' videos to '{}'"\
             .format(informat, outformat))
-    return
+    return True
 
 
 def upgrade_video(indir, reldir, files, outdir, formats=["avi"]):
     for f in files:
         infile = os.path.abspath(os.path.join(indir, reldir, f))
-        if is_video(infile):
+        if media_kind(infile) == "video":
             inroot, chk = file_rootname(infile)
             inbase, format = file_format(inroot)
             if format in formats:
@@ -235,5 +656,11 @@ def upgrade_video(indir, reldir, files, outdir, formats=["avi"]):
                 os.makedirs(outloc, exist_ok=True)
                 outfile = os.path.abspath(
                     os.path.join(outloc, "{}.{}".format(inbase, "m4v")))
-                convert_video(infile, outfile)
+                try:
+                    if convert_video(infile, outfile):
+                        print("Finished converting {}".format(infile),
+                            flush=True)
+                except RuntimeError as e:
+                    print("Conversion failed for {}: {}".format(infile, e),
+                        flush=True)
     return
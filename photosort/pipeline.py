@@ -0,0 +1,197 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import time
+import collections
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .media import Image, Video, file_json
+
+from .scan import scan_tree
+
+from .hashing import file_digest, file_drop_cache
+
+from .exiftool import exiftool_pool
+
+from .similar import image_dhash
+
+from .ops import (import_object, plan_imports, repair_journal, album_name,
+    materialize_album)
+
+
+class ImportStats(object):
+    """Counters for a pipelined import.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.scanned = 0
+        self.skipped = 0
+        self.hashed = 0
+        self.hashed_bytes = 0
+        self.found = 0
+        self.imported = 0
+        self.imported_bytes = 0
+        self.journaled = 0
+        self.repaired = 0
+
+    def summary(self):
+        elapsed = max(time.time() - self.start, 1.0e-6)
+        lines = list()
+        lines.append("Processed {} media files ({:.2f}MB) in {:.1f}s"\
+            .format(self.hashed, self.hashed_bytes / 1.0e6, elapsed))
+        lines.append("  {:.1f} files/s, {:.2f}MB/s"\
+            .format(self.hashed / elapsed,
+            self.hashed_bytes / 1.0e6 / elapsed))
+        lines.append("  {} imported ({:.2f}MB), {} already in DB, "
+            "{} non-media files skipped".format(self.imported,
+            self.imported_bytes / 1.0e6, self.found, self.skipped))
+        if self.journaled > 0:
+            lines.append("  {} files already imported by an earlier run"\
+                .format(self.journaled))
+        if self.repaired > 0:
+            lines.append("  {} interrupted imports repaired".format(
+                self.repaired))
+        return "\n".join(lines)
+
+
+def _scan(indir, stats, exclude=None):
+    """Yield the ScanEntry of every media file below indir.
+    """
+    for rec in scan_tree(indir, exclude=exclude):
+        stats.scanned += 1
+        if rec.kind is None:
+            print("skipping non-media file {}".format(rec.path))
+            stats.skipped += 1
+            continue
+        yield rec
+
+
+def _hash(rec, hashalg):
+    chk, fprint = file_digest(rec.path, algorithm=hashalg, fingerprint=True)
+    return chk, fprint, rec.stat
+
+
+def _meta(rec):
+    # The metadata, and for images the perceptual hash, which decodes the
+    # image and so is best done in a worker too.
+    meta = file_json(rec.path)
+    value = None
+    if rec.kind == "image":
+        value = image_dhash(rec.path, meta)
+    return meta, value
+
+
+def import_tree(db, indir, outroot, albumdir, file_time=False, jobs=1,
+    window=None, exclude=None, journal=True):
+    """Import all media below indir using a pool of worker threads.
+
+    Hashing, metadata extraction and perceptual hashing of images run in
+    jobs worker threads.  The calling thread is the only writer:  it
+    checks every checksum against the DB, creates directories, copies
+    files and inserts rows, in the same order as a serial walk of the
+    input.  At most window files are in flight at once.  Files matching
+    the exclude patterns (see ExcludeRules) are ignored.  The links of the
+    albums which got new members are made at the end, with
+    materialize_album.
+
+    Imports interrupted by a crash are first finished from the journal
+    (see repair_journal).  Unless journal is False, unchanged inputs that
+    an earlier run imported are then skipped without hashing them.
+
+    Returns the ImportStats of the run.
+    """
+    jobs = max(1, int(jobs))
+    if window is None:
+        window = 4 * jobs
+    stats = ImportStats()
+    exiftool_pool(jobs)
+    hashalg = db.hashalg
+    stats.repaired = repair_journal(db)
+    db.preload_digests()
+
+    files = _scan(indir, stats, exclude=exclude)
+    hashq = collections.deque()
+    metaq = collections.deque()
+    albums = set()
+
+    def load(rec, chk, fprint, st, meta, value):
+        if rec.kind == "image":
+            obj = Image(rec.path, file_time, meta=meta, md5=chk, st=st,
+                hashalg=hashalg, fprint=fprint)
+        else:
+            obj = Video(rec.path, file_time, meta=meta, md5=chk, st=st,
+                hashalg=hashalg, fprint=fprint)
+        obj.dhash = value
+        return obj
+
+    def commit(rec, obj):
+        print("importing {}".format(rec.path))
+        # An identical file may have been imported since it was hashed.
+        if db.query_md5(obj.md5):
+            print("  found in DB")
+            stats.found += 1
+            db.journal_record(rec.path, obj.stat, obj.md5, None,
+                "committed")
+            return
+        import_object(db, obj, rec.dirpath, outroot, albumdir, planned=True)
+        if albumdir is not None:
+            albums.add(album_name(rec.dirpath))
+        stats.imported += 1
+        stats.imported_bytes += obj.stat.st_size
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        done_scanning = False
+        while True:
+            while (not done_scanning) and \
+                (len(hashq) + len(metaq) < window):
+                try:
+                    rec = next(files)
+                except StopIteration:
+                    done_scanning = True
+                    break
+                if journal and db.journal_done(rec.path, rec.stat):
+                    print("{} already imported".format(rec.path))
+                    stats.journaled += 1
+                    continue
+                hashq.append((rec, pool.submit(_hash, rec, hashalg)))
+
+            if (len(hashq) == 0) and (len(metaq) == 0):
+                break
+
+            # Commit finished objects in order.  Once there is nothing left
+            # to hash, block on the oldest ones.  The copies of each group
+            # are planned in the journal with a single commit.
+            ready = list()
+            while (len(metaq) > 0) and \
+                (metaq[0][-1].done() or (len(hashq) == 0)):
+                rec, chk, fprint, st, fut = metaq.popleft()
+                meta, value = fut.result()
+                ready.append((rec, load(rec, chk, fprint, st, meta, value)))
+            plan_imports(db, [x[1] for x in ready if \
+                not db.query_md5(x[1].md5)], outroot)
+            for rec, obj in ready:
+                commit(rec, obj)
+
+            if len(hashq) > 0:
+                rec, fut = hashq.popleft()
+                chk, fprint, st = fut.result()
+                stats.hashed += 1
+                stats.hashed_bytes += st.st_size
+                print("checking {}".format(rec.path))
+                if db.query_md5(chk):
+                    # Duplicates are not copied, so their pages are not
+                    # needed again.
+                    print("  found in DB")
+                    stats.found += 1
+                    file_drop_cache(rec.path)
+                    db.journal_record(rec.path, st, chk, None, "committed")
+                else:
+                    metaq.append((rec, chk, fprint, st,
+                        pool.submit(_meta, rec)))
+    db.commit()
+    for album in sorted(albums):
+        materialize_album(db, albumdir, album)
+    return stats
@@ -0,0 +1,164 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import re
+import struct
+
+from .exiftool import exiftool_pool, ExifToolError
+
+from .instrument import stage
+
+try:
+    from PIL import Image as PILImage
+    have_pillow = True
+except ImportError:
+    have_pillow = False
+
+
+# Ways of producing reduced resolution images.  "auto" uses Pillow for
+# the files it can handle when it is installed, and ImageMagick otherwise.
+resize_backends = ["auto", "pillow", "convert"]
+
+# Linear scale of each export resolution.
+resolution_scale = {
+    "MED": 0.5,
+    "LOW": 0.25,
+}
+
+# Extensions of the files scaled in-process.  These are the formats where
+# the decoder can skip most of the work (JPEG DCT scaling), and whose EXIF
+# block can be copied verbatim.
+pillow_ext = ["jpg", "jpeg"]
+
+# Tags which hold JPEG previews embedded in RAW files.
+preview_tags = ["JpgFromRaw", "PreviewImage", "OtherImage"]
+
+
+def pillow_enabled(backend="auto"):
+    """Return True if JPEG data should be scaled in-process.
+    """
+    if backend not in resize_backends:
+        raise RuntimeError("unknown resize backend {}".format(backend))
+    if backend == "convert":
+        return False
+    if not have_pillow:
+        if backend == "pillow":
+            raise RuntimeError("the pillow resize backend needs the PIL "
+                "package")
+        return False
+    return True
+
+
+def resize_supported(filename, backend="auto"):
+    """Return True if the file should be scaled in-process.
+    """
+    if not pillow_enabled(backend):
+        return False
+    ext = os.path.splitext(filename)[1].lstrip(".").lower()
+    return (ext in pillow_ext)
+
+
+def jpeg_dimensions(data):
+    """Return the (width, height) of JPEG data from its frame header.
+
+    Returns None if the data is not a JPEG stream.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    off = 2
+    while off + 9 <= len(data):
+        if data[off] != 0xff:
+            return None
+        marker = data[off + 1]
+        if marker == 0xff:
+            # Fill byte
+            off += 1
+            continue
+        if (0xc0 <= marker <= 0xcf) and (marker not in (0xc4, 0xc8, 0xcc)):
+            height, width = struct.unpack(">HH", data[off+5:off+9])
+            return (width, height)
+        seglen = struct.unpack(">H", data[off+2:off+4])[0]
+        off += 2 + seglen
+    return None
+
+
+def raw_dimensions(meta):
+    """Return the full (width, height) of an image from its metadata.
+    """
+    size = meta.get("ImageSize", None)
+    if size is not None:
+        mat = re.match(r"(\d+)\D+(\d+)", str(size))
+        if mat is not None:
+            return (int(mat.group(1)), int(mat.group(2)))
+    try:
+        return (int(meta["ImageWidth"]), int(meta["ImageHeight"]))
+    except (KeyError, ValueError, TypeError):
+        return None
+
+
+def embedded_preview(filename, meta, size):
+    """Extract the largest JPEG preview of a RAW file.
+
+    The sizes of the previews are taken from the exiftool metadata of the
+    file, and only the largest one is extracted.  Returns the JPEG data
+    and its (width, height), or None if there is no preview with a long
+    side of at least the long side of size.
+    """
+    best = None
+    for tag in preview_tags:
+        mat = re.search(r"Binary data (\d+) bytes", str(meta.get(tag, "")))
+        if (mat is not None) and ((best is None) or \
+            (int(mat.group(1)) > best[1])):
+            best = (tag, int(mat.group(1)))
+    if best is None:
+        return None
+    try:
+        data = exiftool_pool().execute(["-b", "-{}".format(best[0]),
+            filename])
+    except ExifToolError:
+        return None
+    dims = jpeg_dimensions(data)
+    if (dims is None) or (max(dims) < max(size)):
+        return None
+    return data, dims
+
+
+def resize_jpeg(src, dst, scale=None, quality=95, size=None):
+    """Write a scaled copy of a JPEG file, keeping its EXIF and ICC data.
+
+    The output has the given (width, height) size, or is the input scaled
+    by scale.  src may be a path or a file object.  The image is decoded
+    in draft mode, so that the JPEG decoder already produces the nearest
+    power of two reduction, and only the remaining factor is resampled.
+    Returns False if Pillow is not available or cannot decode the file.
+    """
+    if not have_pillow:
+        return False
+    try:
+        with stage("resize"), PILImage.open(src) as img:
+            width, height = img.size
+            if size is None:
+                size = (max(1, int(round(width * scale))),
+                    max(1, int(round(height * scale))))
+            mode = img.mode
+            if mode not in ("RGB", "L", "CMYK"):
+                mode = "RGB"
+            img.draft(mode, size)
+            info = dict(img.info)
+            out = img.convert(mode) if img.mode != mode else img
+            if out.size != size:
+                out = out.resize(size, PILImage.LANCZOS)
+            opts = dict(quality=quality)
+            if "exif" in info:
+                opts["exif"] = info["exif"]
+            if "icc_profile" in info:
+                opts["icc_profile"] = info["icc_profile"]
+            out.save(dst, "JPEG", **opts)
+    except (OSError, ValueError, SyntaxError,
+        PILImage.DecompressionBombError):
+        # Leave dst (possibly partially written) to the fallback, which
+        # overwrites it.
+        return False
+    return True
@@ -0,0 +1,150 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import re
+import fnmatch
+
+from .media import media_kinds
+
+
+class ScanEntry(object):
+    """A file found by scan_tree.
+
+    The stat of the file comes from the os.DirEntry, which caches it, so
+    it is fetched at most once.  kind is "image", "video" or None.
+    """
+
+    __slots__ = ("path", "relpath", "dirpath", "name", "ext", "kind",
+        "_entry")
+
+    def __init__(self, entry, dirpath, relpath):
+        self._entry = entry
+        self.name = entry.name
+        self.path = entry.path
+        self.dirpath = dirpath
+        self.relpath = relpath
+        root, dot, ext = entry.name.rpartition(".")
+        if dot == "":
+            self.ext = None
+            self.kind = None
+        else:
+            self.ext = ext.lower()
+            self.kind = media_kinds.get(self.ext, None)
+
+    @property
+    def stat(self):
+        return self._entry.stat()
+
+
+class ExcludeRules(object):
+    """Glob patterns of paths to leave out of a scan.
+
+    A pattern is matched against both the name and the path relative to
+    the top of the scan.  Patterns ending with "/" only match directories,
+    whose whole subtree is then skipped.
+    """
+
+    def __init__(self, patterns=None):
+        files = list()
+        dirs = list()
+        for pat in (patterns or []):
+            if pat.endswith("/"):
+                dirs.append(pat.rstrip("/"))
+            else:
+                files.append(pat)
+                dirs.append(pat)
+        self._files = self._compile(files)
+        self._dirs = self._compile(dirs)
+
+    @staticmethod
+    def _compile(patterns):
+        if len(patterns) == 0:
+            return None
+        return re.compile("|".join(
+            ["(?:{})".format(fnmatch.translate(x)) for x in patterns]))
+
+    def _match(self, regex, name, relpath):
+        if regex is None:
+            return False
+        return (regex.match(name) is not None) or \
+            (regex.match(relpath) is not None)
+
+    def file(self, name, relpath):
+        return self._match(self._files, name, relpath)
+
+    def dir(self, name, relpath):
+        return self._match(self._dirs, name, relpath)
+
+
+def scan_tree(top, exclude=None, kinds=None):
+    """Yield a ScanEntry for every file below top.
+
+    Directories are visited in the same order as os.walk, and symbolic
+    links to directories are not followed.  exclude is a list of patterns
+    (see ExcludeRules).  If kinds is given, only files of those kinds of
+    media are yielded, and if it contains None non-media files are too.
+    """
+    rules = exclude
+    if not isinstance(rules, ExcludeRules):
+        rules = ExcludeRules(exclude)
+    if kinds is not None:
+        kinds = frozenset(kinds)
+    top = os.path.abspath(top)
+    stack = [(top, "")]
+    while len(stack) > 0:
+        dirpath, reldir = stack.pop()
+        subdirs = list()
+        try:
+            it = os.scandir(dirpath)
+        except OSError as e:
+            print("cannot scan {}: {}".format(dirpath, e), file=sys.stderr)
+            continue
+        with it:
+            for entry in it:
+                if reldir == "":
+                    rel = entry.name
+                else:
+                    rel = os.path.join(reldir, entry.name)
+                try:
+                    isdir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    isdir = False
+                if isdir:
+                    if not rules.dir(entry.name, rel):
+                        subdirs.append((entry.path, rel))
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                except OSError:
+                    continue
+                if rules.file(entry.name, rel):
+                    continue
+                rec = ScanEntry(entry, dirpath, rel)
+                if (kinds is not None) and (rec.kind not in kinds):
+                    continue
+                yield rec
+        # Visit subdirectories in order after this one.
+        stack.extend(reversed(subdirs))
+    return
+
+
+def scan_dirs(top, exclude=None, kinds=None):
+    """Like scan_tree, but yield (directory, list of ScanEntry) per directory.
+
+    Directories without matching files are skipped.
+    """
+    current = None
+    entries = list()
+    for rec in scan_tree(top, exclude=exclude, kinds=kinds):
+        if rec.dirpath != current:
+            if len(entries) > 0:
+                yield current, entries
+            current = rec.dirpath
+            entries = list()
+        entries.append(rec)
+    if len(entries) > 0:
+        yield current, entries
+    return
@@ -0,0 +1,93 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import re
+import zlib
+
+from .scan import ExcludeRules
+
+
+# Ways of splitting a media tree into shards:  whole top level (year)
+# directories, or single files by a hash of their path.
+shard_modes = ["year", "hash"]
+
+_shard_spec = re.compile(r"^\s*(\d+)\s*/\s*(\d+)\s*$")
+_shard_file = re.compile(r"^photosync-shard-(\d+)-of-(\d+)\.db$")
+
+
+def parse_shard(spec):
+    """Parse a shard given as "I/N" (I from 1 to N) into (I, N).
+    """
+    match = _shard_spec.match(spec)
+    if match is None:
+        raise RuntimeError("shard must be given as I/N, not {}".format(spec))
+    index = int(match.group(1))
+    count = int(match.group(2))
+    if (count < 1) or (index < 1) or (index > count):
+        raise RuntimeError("shard {} is out of range".format(spec))
+    return index, count
+
+
+def shard_db_name(index, count):
+    """File name of the DB of one shard.
+    """
+    return "photosync-shard-{:d}-of-{:d}.db".format(index, count)
+
+
+def parse_shard_db_name(name):
+    """Return (I, N) for the file name of a shard DB, or None.
+    """
+    match = _shard_file.match(os.path.basename(name))
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_of(relpath, count, mode="year"):
+    """Return the shard (from 1 to count) of a path relative to the top of
+    the media tree.
+
+    The result only depends on the path, so every node computes the same
+    partition.  In "year" mode consecutive years go to consecutive shards,
+    and other top level names are hashed.  In "hash" mode the whole path
+    is hashed, which balances the shards best.
+    """
+    if mode == "year":
+        top = relpath.split(os.sep, 1)[0]
+        if top.isdigit():
+            return (int(top) % count) + 1
+        key = top
+    elif mode == "hash":
+        key = relpath
+    else:
+        raise RuntimeError("unknown shard mode {}".format(mode))
+    return (zlib.crc32(key.encode("utf-8")) % count) + 1
+
+
+class ShardRules(ExcludeRules):
+    """Exclude rules which also leave out everything outside one shard.
+
+    Pass them to scan_tree or scan_dirs of the top of the media tree.  In
+    "year" mode the top level directories of other shards are not entered
+    at all.
+    """
+
+    def __init__(self, index, count, mode="year", patterns=None):
+        super(ShardRules, self).__init__(patterns)
+        if mode not in shard_modes:
+            raise RuntimeError("unknown shard mode {}".format(mode))
+        self.index = index
+        self.count = count
+        self.mode = mode
+
+    def file(self, name, relpath):
+        if shard_of(relpath, self.count, self.mode) != self.index:
+            return True
+        return super(ShardRules, self).file(name, relpath)
+
+    def dir(self, name, relpath):
+        if (self.mode == "year") and (relpath == name) and \
+            (shard_of(relpath, self.count, self.mode) != self.index):
+            return True
+        return super(ShardRules, self).dir(name, relpath)
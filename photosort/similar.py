@@ -0,0 +1,193 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import io
+
+from .instrument import stage
+
+from .resize import pillow_ext, embedded_preview
+
+try:
+    from PIL import Image as PILImage
+    have_pillow = True
+except ImportError:
+    have_pillow = False
+
+
+# Default largest Hamming distance between the difference hashes of two
+# images that are reported as near-duplicates.  Re-encoded and resized
+# copies are typically within 0-4 bits, unrelated images around 32.
+near_distance = 6
+
+# Bits per side of the difference hash (64 bit hashes).
+dhash_size = 8
+
+# Transpose operations for each EXIF orientation.
+if have_pillow:
+    _orientation = {
+        2: [PILImage.FLIP_LEFT_RIGHT],
+        3: [PILImage.ROTATE_180],
+        4: [PILImage.FLIP_TOP_BOTTOM],
+        5: [PILImage.TRANSPOSE],
+        6: [PILImage.ROTATE_270],
+        7: [PILImage.TRANSVERSE],
+        8: [PILImage.ROTATE_90],
+    }
+
+
+def hamming(a, b):
+    """Number of differing bits of two hashes.
+    """
+    return bin(a ^ b).count("1")
+
+
+def to_signed(value):
+    """Convert a 64 bit hash to the signed integer stored by sqlite.
+    """
+    if (value is not None) and (value >= 2**63):
+        return value - 2**64
+    return value
+
+
+def from_signed(value):
+    if (value is not None) and (value < 0):
+        return value + 2**64
+    return value
+
+
+def dhash(src, size=dhash_size):
+    """Compute the difference hash of an image.
+
+    The image is reduced to (size + 1) x size gray pixels, and each bit of
+    the hash tells whether a pixel is brighter than its right neighbour.
+    JPEGs are decoded in draft mode, so this costs a fraction of a full
+    decode.  The EXIF orientation is applied first, so that rotated copies
+    match.  src may be a path or a file object.  Returns the hash as an
+    integer of size * size bits, or None if Pillow is not available or
+    cannot decode the image.
+    """
+    if not have_pillow:
+        return None
+    try:
+        with stage("dhash"), PILImage.open(src) as img:
+            orientation = None
+            try:
+                orientation = img.getexif().get(0x0112, None)
+            except Exception:
+                pass
+            img.draft("L", (8 * (size + 1), 8 * size))
+            gray = img.convert("L")
+            for op in _orientation.get(orientation, []):
+                gray = gray.transpose(op)
+            small = gray.resize((size + 1, size), PILImage.BOX)
+            pixels = small.tobytes()
+    except (OSError, ValueError, SyntaxError,
+        PILImage.DecompressionBombError):
+        return None
+    value = 0
+    for row in range(size):
+        off = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | \
+                (pixels[off + col] > pixels[off + col + 1])
+    return value
+
+
+def image_dhash(filename, meta=None):
+    """Compute the difference hash of an image file, or return None.
+
+    JPEGs are hashed directly, and RAW files through their largest
+    embedded JPEG preview, which needs the exiftool metadata.
+    """
+    if not have_pillow:
+        return None
+    ext = os.path.splitext(filename)[1].lstrip(".").lower()
+    if ext in pillow_ext:
+        return dhash(filename)
+    if meta is None:
+        return None
+    preview = embedded_preview(filename, meta, (64, 64))
+    if preview is None:
+        return None
+    return dhash(io.BytesIO(preview[0]))
+
+
+class HammingIndex(object):
+    """Multi-index hashing of bits-bit hashes under the Hamming distance.
+
+    Each hash is split into chunks parts, and every part has a table of
+    the hashes by the value of that part.  If two hashes are within
+    distance d, by the pigeonhole principle one of their parts differs in
+    at most d // chunks bits, so a search only looks up the parts of the
+    query with up to that many bits flipped, and checks the candidates
+    with hamming().  With 16 bit parts a search within distance 6 looks at
+    68 buckets of (for random hashes) len / 65536 entries each, instead of
+    most of the index.
+    """
+
+    def __init__(self, bits=dhash_size * dhash_size, chunks=4):
+        self.bits = bits
+        self.chunks = chunks
+        self._width = (bits + chunks - 1) // chunks
+        self._mask = (1 << self._width) - 1
+        self._tables = [dict() for x in range(chunks)]
+        self._items = dict()
+        self._flips = dict()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _parts(self, key):
+        w = self._width
+        return [(key >> (x * w)) & self._mask for x in range(self.chunks)]
+
+    def _masks(self, radius):
+        # All values of one part with at most radius bits set.
+        masks = self._flips.get(radius, None)
+        if masks is None:
+            masks = [0]
+            for bit in range(self._width):
+                masks.extend([x | (1 << bit) for x in masks if \
+                    bin(x).count("1") < radius])
+            self._flips[radius] = masks
+        return masks
+
+    def add(self, key, item):
+        self._size += 1
+        items = self._items.get(key, None)
+        if items is not None:
+            items.append(item)
+            return
+        self._items[key] = [item]
+        for tab, part in zip(self._tables, self._parts(key)):
+            bucket = tab.get(part, None)
+            if bucket is None:
+                tab[part] = [key]
+            else:
+                bucket.append(key)
+
+    def search(self, key, maxdist):
+        """Return the (distance, item) pairs within maxdist of key, closest
+        first.
+        """
+        ret = list()
+        masks = self._masks(maxdist // self.chunks)
+        if len(masks) * self.chunks >= len(self._items):
+            # Large distances are cheaper to check one by one.
+            cands = self._items.keys()
+        else:
+            cands = set()
+            for tab, part in zip(self._tables, self._parts(key)):
+                for m in masks:
+                    bucket = tab.get(part ^ m, None)
+                    if bucket is not None:
+                        cands.update(bucket)
+        for cand in cands:
+            dist = hamming(key, cand)
+            if dist <= maxdist:
+                ret.extend([(dist, x) for x in self._items[cand]])
+        ret.sort()
+        return ret
@@ -0,0 +1,204 @@
+from __future__ import (absolute_import, division, print_function,
+    unicode_literals)
+
+import os
+import sys
+import errno
+import shutil
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from .instrument import stage
+
+
+# ioctl request number of FICLONE (_IOW(0x94, 9, int)) on Linux.
+FICLONE = 0x40049409
+
+# Errors which mean "this copy method is not available here", as opposed
+# to a real I/O problem.
+_unsupported = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+    errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM,
+    errno.ENOTSUP])
+
+copy_blocksize = 2**20
+
+# Ways of placing a full-size copy of a file in an export tree.
+link_modes = ["reflink", "copy", "hardlink"]
+
+
+def date_timestamp(date):
+    """Convert a (year, month, day, hour, minute, second) tuple to a time.
+    """
+    datestr = "{:04d}:{:02d}:{:02d} {:02d}:{:02d}:{:02d}".format(int(date[0]),
+        int(date[1]), int(date[2]), int(date[3]), int(date[4]), int(date[5]))
+    st = time.strptime(datestr, "%Y:%m:%d %H:%M:%S")
+    return time.mktime(st)
+
+
+def set_file_date(filename, date):
+    """Set the access and modification times of a file (local time).
+    """
+    with stage("setdate"):
+        systime = date_timestamp(date)
+        os.utime(filename, times=(systime, systime))
+    return
+
+
+def _reflink(fsrc, fdst, offset, size):
+    if (fcntl is None) or (offset != 0):
+        return offset
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except (OSError, IOError) as e:
+        if e.errno in _unsupported:
+            return offset
+        raise
+    return size
+
+
+def _copy_range(fsrc, fdst, offset, size):
+    if not hasattr(os, "copy_file_range"):
+        return offset
+    while offset < size:
+        try:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                min(size - offset, 2**30), offset, offset)
+        except OSError as e:
+            if e.errno in _unsupported:
+                return offset
+            raise
+        if n == 0:
+            break
+        offset += n
+    return offset
+
+
+def _sendfile(fsrc, fdst, offset, size):
+    if not hasattr(os, "sendfile"):
+        return offset
+    os.lseek(fdst.fileno(), offset, os.SEEK_SET)
+    while offset < size:
+        try:
+            n = os.sendfile(fdst.fileno(), fsrc.fileno(), offset,
+                min(size - offset, 2**30))
+        except OSError as e:
+            if e.errno in _unsupported:
+                return offset
+            raise
+        if n == 0:
+            break
+        offset += n
+    return offset
+
+
+def _buffered(fsrc, fdst, offset, size):
+    fsrc.seek(offset)
+    fdst.seek(offset)
+    buf = bytearray(copy_blocksize)
+    view = memoryview(buf)
+    while True:
+        n = fsrc.readinto(buf)
+        if not n:
+            break
+        fdst.write(view[:n])
+        offset += n
+    return offset
+
+
+# Copy methods, fastest first.  Each one continues from the offset where
+# the previous one gave up.
+_methods = [
+    ("reflink", _reflink),
+    ("copy_file_range", _copy_range),
+    ("sendfile", _sendfile),
+    ("buffered", _buffered),
+]
+
+
+def copy_file(src, dst, date=None, reflink=True, fsync=True):
+    """Copy a file atomically, using the fastest method available.
+
+    The data goes to a temporary file in the destination directory, which
+    is renamed to dst once it is complete, so an interrupted copy never
+    leaves a truncated dst behind.  Permissions and times are copied
+    from src, and if date is given the times are then set to that date.
+    Returns the name of the method that copied the data.
+    """
+    dirname = os.path.dirname(os.path.abspath(dst))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".part",
+        prefix=".{}.".format(os.path.basename(dst)))
+    try:
+        with stage("copy") as t, open(src, "rb", buffering=0) as fsrc, \
+            os.fdopen(fd, "wb", buffering=0) as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            t.add(nbytes=size)
+            offset = 0
+            used = None
+            for name, method in _methods:
+                if (name == "reflink") and (not reflink):
+                    continue
+                start = offset
+                offset = method(fsrc, fdst, offset, size)
+                if offset > start:
+                    used = name
+                if (offset >= size) and (name != "buffered"):
+                    break
+            if used is None:
+                used = "buffered"
+            if fsync:
+                os.fsync(fdst.fileno())
+        shutil.copystat(src, tmp)
+        if date is not None:
+            set_file_date(tmp, date)
+        os.replace(tmp, dst)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return used
+
+
+def link_file(src, dst):
+    """Atomically replace dst with a hard link to src.
+
+    Returns False without touching dst if src and dst are on different
+    file systems, or the file system does not support hard links.
+    """
+    dirname = os.path.dirname(os.path.abspath(dst))
+    tmp = os.path.join(dirname, ".{}.{}.link".format(os.path.basename(dst),
+        os.getpid()))
+    try:
+        with stage("link"):
+            os.link(src, tmp)
+    except OSError as e:
+        if e.errno in _unsupported:
+            return False
+        raise
+    try:
+        os.replace(tmp, dst)
+    except:
+        os.remove(tmp)
+        raise
+    return True
+
+
+def place_file(src, dst, mode="reflink"):
+    """Put the contents of src at dst using one of the link_modes.
+
+    "reflink" shares the data blocks with src where the file system
+    supports it and copies otherwise, "copy" always duplicates the data,
+    and "hardlink" links dst to src, falling back to a copy across file
+    systems.  Returns the method that was used.
+    """
+    if mode not in link_modes:
+        raise RuntimeError("unknown link mode {}".format(mode))
+    if mode == "hardlink":
+        if link_file(src, dst):
+            return "hardlink"
+        mode = "reflink"
+    return copy_file(src, dst, reflink=(mode == "reflink"))
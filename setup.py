@@ -31,7 +31,9 @@ setup (
     url = 'https://github.com/tskisner/photosort',
     packages = [ 'photosort' ],
     scripts = [ 'phts_sync', 'phts_dirmd5', 'phts_album', 'phts_verify', 'phts_fixdate',
-                'phts_info', 'phts_export', 'phts_convert_video' ],
+                'phts_info', 'phts_export', 'phts_convert_video', 'phts_query',
+                'phts_dupes',
+                'phts_merge' ],
     license = 'None',
     requires = ['Python (>3.3.0)', ]
 )